@@ -0,0 +1,432 @@
+#!/usr/bin/python3
+import argparse
+import queue
+import threading
+import time
+import traceback
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from metrics import instrumentation, scale_label
+from sensors import sensor_ready, sensor_period
+
+class AcquisitionEngine:
+    """Long-lived acquisition: one reader thread per HX711 channel, delivering synchronised frames.
+
+    Each frame is a (timestamp, readings) tuple holding one reading from every channel.
+    Frames are delivered through a bounded queue; when the consumer falls behind the
+    oldest frame is dropped so the queue always holds the most recent readings. Given a
+    `sink`, frames are passed to `sink(timestamp, readings)` instead of the queue.
+    """
+
+    def __init__(self, sensors, queue_size=1024, rate_interval=1.0, scheduler=None, name=None, sink=None):
+        self.sensors = list(sensors)
+        self.channels = len(self.sensors)
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.sink = sink
+        self.rate_interval = rate_interval
+        self.scheduler = scheduler
+        self.name = name
+        self.labels = [f"{name}:{index}" if name else str(index) for index in range(len(self.sensors))]
+        self.metric_labels = [(scale_label(name), str(index)) for index in range(len(self.sensors))]
+
+        self.frame_count = 0
+        self.dropped_frames = 0
+        self.invalid_frames = 0
+        self.samples_per_second = 0.0
+
+        self._readings = [None] * len(self.sensors)
+        self._have = [False] * len(self.sensors)
+        # When the scheduler next expects each sensor to have a conversion ready
+        self.due = [0.0] * len(self.sensors)
+        self._frame_lock = threading.Lock()
+        self._barrier = threading.Barrier(len(self.sensors), action=self._emit_frame)
+        self._stop_event = threading.Event()
+        self._threads = []
+        self._rate_start = time.monotonic()
+        self._rate_count = 0
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop_event.clear()
+        self._barrier.reset()
+        self._rate_start = time.monotonic()
+        self._rate_count = 0
+        if self.scheduler is not None:
+            self.scheduler.add(self)
+            return
+        for index in range(len(self.sensors)):
+            thread = threading.Thread(target=self._reader, args=(index,), name=f"hx711-reader-{index}")
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        if self.scheduler is not None:
+            self.scheduler.remove(self)
+        self._stop_event.set()
+        self._barrier.abort()
+        for thread in self._threads:
+            thread.join(timeout=2)
+        self._threads = []
+
+    def _read(self, index):
+        timed = instrumentation.enabled
+        if timed:
+            start = time.perf_counter()
+        try:
+            reading = self.sensors[index].get_raw_data(times=1)[0]
+        except Exception as e:
+            print(f"Exception reading sensor {self.labels[index]}", e)
+            traceback.print_exc()
+            reading = None
+        if timed:
+            label = self.metric_labels[index]
+            instrumentation.record_read(label, time.perf_counter() - start)
+            if reading is None or reading is False:
+                instrumentation.invalid_reads.inc(label=label)
+        return reading
+
+    def _reader(self, index):
+        while not self._stop_event.is_set():
+            self._readings[index] = self._read(index)
+
+            try:
+                self._barrier.wait()
+            except threading.BrokenBarrierError:
+                break
+
+    def needs(self, index):
+        """Whether the frame being assembled still lacks a reading from sensor `index`."""
+        return not self._have[index]
+
+    def collect(self, index, reading):
+        # Used by the scheduler in place of the barrier
+        with self._frame_lock:
+            self._readings[index] = reading
+            self._have[index] = True
+            if all(self._have):
+                self._have = [False] * len(self.sensors)
+                self._emit_frame()
+
+    def _emit_frame(self):
+        # Runs in exactly one reader thread once every channel has a reading
+        readings = tuple(self._readings)
+        self._readings = [None] * len(self.sensors)
+        if any(reading is None or reading is False for reading in readings):
+            self.invalid_frames += 1
+            return
+
+        frame = (time.time(), readings)
+        if self.sink is not None:
+            self.sink(*frame)
+        else:
+            self._put(frame)
+
+        self.frame_count += 1
+        self._rate_count += 1
+        now = time.monotonic()
+        elapsed = now - self._rate_start
+        if elapsed >= self.rate_interval:
+            self.samples_per_second = self._rate_count / elapsed
+            self._rate_start = now
+            self._rate_count = 0
+
+    def _put(self, frame):
+        try:
+            self.frames.put_nowait(frame)
+        except queue.Full:
+            try:
+                self.frames.get_nowait()
+            except queue.Empty:
+                pass
+            self.frames.put_nowait(frame)
+            self.dropped_frames += 1
+            instrumentation.dropped_frames.inc(label=scale_label(self.name))
+
+    def discard_frames(self):
+        while True:
+            try:
+                self.frames.get_nowait()
+            except queue.Empty:
+                return
+
+    def get_frame(self, timeout=None):
+        return self.frames.get(timeout=timeout)
+
+    def read_frames(self, duration, interrupt=None, done=None, min_frames=16):
+        """Collect the frames produced over the next `duration` seconds.
+
+        Stops early if the `interrupt` event is set, or once `done(timestamps, readings)`
+        returns True. `done` is first asked at `min_frames` frames and then every time the
+        count grows by a quarter, so checking costs a constant factor over the window.
+        Returns an array of timestamps and an (n, channels) int32 block of raw readings,
+        both preallocated for the expected frame rate and grown by doubling if more frames arrive.
+        """
+        self.discard_frames()
+        capacity = max(64, int(duration * max(self.samples_per_second, 1.0) * 1.25))
+        timestamps = np.empty(capacity)
+        readings = np.empty((capacity, len(self.sensors)), dtype=np.int32)
+        count = 0
+        next_check = min_frames
+        end_time = time.monotonic() + duration
+        while True:
+            remaining = end_time - time.monotonic()
+            if remaining <= 0 or (interrupt is not None and interrupt.is_set()):
+                break
+            try:
+                timestamp, frame = self.frames.get(timeout=min(remaining, 0.1))
+            except queue.Empty:
+                continue
+            if count == len(timestamps):
+                timestamps = np.resize(timestamps, 2 * count)
+                readings = np.resize(readings, (2 * count, len(self.sensors)))
+            timestamps[count] = timestamp
+            readings[count] = frame
+            count += 1
+            if done is not None and count >= next_check:
+                if done(timestamps[:count], readings[:count]):
+                    break
+                next_check = count + max(1, count // 4)
+
+        return timestamps[:count], readings[:count]
+
+class HampelFilter:
+    """Drops frames holding a glitched read, by a Hampel test on each channel of the (n, channels) block.
+
+    A reading is an outlier when it is further than `sigma` robust standard deviations from
+    the median of the `window` readings centred on it. The standard deviation is 1.4826 times
+    each channel's median absolute deviation from those running medians over the block,
+    which is steadier than one per window, floored at `min_deviation` counts. The end of each
+    block is carried over to centre the next block's first readings, and the block's own
+    end is mirrored. A step in the load moves the running median with it, so only isolated
+    reads are dropped.
+    """
+
+    def __init__(self, window=15, sigma=6.0, min_deviation=32, name=None):
+        self.window = max(3, window + 1 if window % 2 == 0 else window)
+        self.half = self.window // 2
+        self.sigma = sigma
+        self.min_deviation = min_deviation
+        self.label = scale_label(name)
+        self.history = None
+
+    def outliers(self, block):
+        """Boolean (n, channels) mask of the block's rejected readings, leaving the carried history unchanged."""
+        history = self._history(block)
+        joined = np.concatenate([history, block])
+        extended = np.pad(joined, ((self.half - len(history), self.half), (0, 0)), mode='reflect')
+        # Partitioning finds the middle of each window without fully sorting it
+        windows = sliding_window_view(extended, self.window, axis=0)
+        medians = np.partition(windows, self.half, axis=-1)[..., self.half]
+        deviation = np.abs(block.astype(np.int64) - medians)
+        scale = 1.4826 * np.median(deviation, axis=0)
+        return deviation > np.maximum(self.sigma * scale, self.min_deviation)
+
+    def _history(self, block):
+        # A short history, left by an interrupted or short block, is mirrored out like a missing one
+        history = self.history
+        if history is None or history.shape[1] != block.shape[1]:
+            return block[:0]
+        return history[-self.half:]
+
+    def apply(self, timestamps, block):
+        """The frames of the block without a rejected reading, counting the rejections per sensor."""
+        if len(block) == 0:
+            return timestamps, block
+        bad = self.outliers(block)
+        self.history = np.concatenate([self._history(block), block])[-self.half:]
+
+        if not bad.any():
+            return timestamps, block
+        for index in np.flatnonzero(bad.any(axis=0)):
+            instrumentation.rejected_reads.inc(int(bad[:, index].sum()), label=(self.label, str(index)))
+        keep = ~bad.any(axis=1)
+        return timestamps[keep], block[keep]
+
+    def reset(self):
+        # The next block does not follow on from the last, as when that one was interrupted
+        self.history = None
+
+class AdaptiveWindow:
+    """Measurement window length that shortens while the load changes and lengthens while it is steady.
+
+    A window whose median differs from the previous one's by more than `change_threshold`
+    times their combined CI width counts as a change, and halves the next window down to
+    `min_duration`. Each steady window lengthens the next by `grow`, up to `max_duration`.
+    """
+
+    def __init__(self, min_duration, max_duration, grow=1.5, change_threshold=1.0):
+        self.min_duration = min(min_duration, max_duration)
+        self.max_duration = max_duration
+        self.grow = grow
+        self.change_threshold = change_threshold
+        self.duration = max_duration
+        self._last = None
+
+    def update(self, median, ci):
+        """Record a window's result, returning whether the load changed."""
+        changed = False
+        if self._last is not None:
+            last_median, last_ci = self._last
+            changed = abs(median - last_median) > self.change_threshold * np.hypot(ci, last_ci)
+        if changed:
+            self.duration = max(self.min_duration, self.duration / 2)
+        else:
+            self.duration = min(self.max_duration, self.duration * self.grow)
+        self._last = (median, ci)
+        return changed
+
+class AcquisitionScheduler:
+    """Reads the sensors of many AcquisitionEngines from a small, fixed pool of threads.
+
+    Each worker polls its share of the sensors and reads whichever have a conversion
+    ready, skipping those that already hold a reading for the frame being assembled.
+    One thread can so service many HX711s, and total throughput grows with the number
+    of scales rather than reads waiting on each other.
+    """
+
+    def __init__(self, workers=4, poll_interval=0.0005, data_rate=80.0, paced=True, max_sleep=0.05):
+        self.workers = max(1, int(workers))
+        self.poll_interval = poll_interval
+        self.data_rate = data_rate
+        self.paced = paced
+        self.max_sleep = max_sleep
+        self._lock = threading.Lock()
+        self._engines = []
+        self._assignments = [[] for _ in range(self.workers)]
+        self._stop_event = threading.Event()
+        self._threads = []
+
+    def add(self, engine):
+        with self._lock:
+            if engine not in self._engines:
+                self._engines.append(engine)
+            self._rebalance()
+            # Scales are created on threads of their own, so only the first add starts the workers
+            self.start()
+
+    def remove(self, engine):
+        with self._lock:
+            if engine in self._engines:
+                self._engines.remove(engine)
+            self._rebalance()
+
+    def _rebalance(self):
+        # Deal the sensors out corner by corner, so each worker's share spans many scales
+        slots = [(engine, index, sensor_period(engine.sensors[index], self.data_rate) if self.paced else 0.0)
+                 for index in range(max((len(e.sensors) for e in self._engines), default=0))
+                 for engine in self._engines if index < len(engine.sensors)]
+        self._assignments = [slots[worker::self.workers] for worker in range(self.workers)]
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop_event.clear()
+        for worker in range(self.workers):
+            thread = threading.Thread(target=self._worker, args=(worker,), name=f"acquisition-{worker}")
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join(timeout=2)
+        self._threads = []
+
+    def _worker(self, worker):
+        # Rather than polling every sensor every `poll_interval`, a sensor just read is left alone
+        # until most of its conversion period has passed, and the worker sleeps until the
+        # earliest one is due
+        while not self._stop_event.is_set():
+            read_any = False
+            now = time.monotonic()
+            wake = now + self.max_sleep
+            for engine, index, period in self._assignments[worker]:
+                due = engine.due[index]
+                if now < due:
+                    wake = min(wake, due)
+                elif engine.needs(index) and sensor_ready(engine.sensors[index]):
+                    engine.collect(index, engine._read(index))
+                    engine.due[index] = time.monotonic() + 0.8 * period
+                    read_any = True
+                else:
+                    wake = min(wake, now + self.poll_interval)
+            if not read_any:
+                time.sleep(max(0.0, wake - time.monotonic()))
+
+def benchmark_executor_per_sample(scales, duration):
+    """The previous approach: a new ThreadPoolExecutor for every 4-channel reading, one scale after another."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    end_time = time.time() + duration
+    count = 0
+    while time.time() < end_time:
+        for sensors in scales:
+            with ThreadPoolExecutor() as executor:
+                futures = [executor.submit(sensor.get_raw_data, 1) for sensor in sensors]
+                sum(future.result()[0] for future in futures)
+            count += 1
+    return count / duration
+
+def benchmark_engines(scales, duration, scheduler=None):
+    """Aggregate frames per second of one engine per scale, run concurrently, and the CPU it took."""
+    cpu_start = time.process_time()
+    engines = [AcquisitionEngine(sensors, scheduler=scheduler, name=str(i)) for i, sensors in enumerate(scales)]
+    for engine in engines:
+        engine.start()
+    results = [None] * len(engines)
+
+    def consume(i):
+        results[i] = len(engines[i].read_frames(duration)[0])
+
+    consumers = [threading.Thread(target=consume, args=(i,)) for i in range(len(engines))]
+    for thread in consumers:
+        thread.start()
+    for thread in consumers:
+        thread.join()
+    for engine in engines:
+        engine.stop()
+    if scheduler is not None:
+        scheduler.stop()
+    return sum(results) / duration, engines, (time.process_time() - cpu_start) / duration
+
+def main():
+    from sensors import create_sensor, SENSOR_BACKENDS, DEFAULT_PINS
+
+    parser = argparse.ArgumentParser(description="Benchmark HX711 acquisition throughput")
+    parser.add_argument("-d", "--duration", type=float, default=5.0, help="Benchmark duration in seconds")
+    parser.add_argument("-c", "--channels", type=int, default=4, help="Number of HX711 channels per scale")
+    parser.add_argument("-s", "--scales", type=int, default=1, help="Number of scales")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="Threads of the shared acquisition scheduler")
+    parser.add_argument("-r", "--rate", type=float, default=80.0, help="Fake sensor data rate in samples per second, 0 for unlimited")
+    parser.add_argument("-b", "--backend", type=str, default='fake', choices=SENSOR_BACKENDS, help="Sensor backend")
+    args = parser.parse_args()
+
+    kwargs = {'sample_rate': args.rate} if args.backend == 'fake' else {}
+    scales = []
+    for scale in range(args.scales):
+        if args.backend == 'fake':
+            kwargs['seed'] = scale
+        scales.append([create_sensor(*DEFAULT_PINS[i % len(DEFAULT_PINS)], backend=args.backend, **kwargs)
+                       for i in range(args.channels)])
+
+    rate = benchmark_executor_per_sample(scales, args.duration)
+    print(f"ThreadPoolExecutor per sample: {rate:.1f} frames/s")
+
+    rate, engines, cpu = benchmark_engines(scales, args.duration)
+    print(f"Thread per sensor:             {rate:.1f} frames/s, {100 * cpu:.0f}% CPU "
+          f"({len(scales) * args.channels} threads, dropped {sum(e.dropped_frames for e in engines)}, "
+          f"invalid {sum(e.invalid_frames for e in engines)})")
+
+    for label, paced in (("Shared scheduler, polling:", False), ("Shared scheduler, paced:", True)):
+        rate, engines, cpu = benchmark_engines(scales, args.duration, AcquisitionScheduler(args.workers, paced=paced))
+        print(f"{label:<30} {rate:.1f} frames/s, {100 * cpu:.0f}% CPU "
+              f"({args.workers} threads, dropped {sum(e.dropped_frames for e in engines)}, "
+              f"invalid {sum(e.invalid_frames for e in engines)})")
+
+if __name__ == "__main__":
+    main()
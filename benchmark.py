@@ -0,0 +1,242 @@
+#!/usr/bin/python3
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from metrics import instrumentation
+from sample_store import SampleStore, RECORD_DTYPE
+
+DEFAULT_SIZES = (1000, 10000, 100000, 1000000)
+
+def make_history(size, sample_duration=1.0, seed=0):
+    """A spool emptying at a steady rate, with noise and the odd outlier, ending now."""
+    rng = np.random.default_rng(seed)
+    records = np.zeros(size, dtype=RECORD_DTYPE)
+    records['timestamp'] = time.time() - sample_duration * np.arange(size)[::-1]
+    records['median'] = 1000 - 0.01 * np.arange(size) + rng.normal(0, 0.5, size)
+    records['median'][rng.random(size) < 0.001] += 50
+    records['ci'] = 0.2
+    records['corners'] = np.nan
+    return records
+
+def make_capture(capture_file, frames=8000, seed=0):
+    """Raw readings of four load cells carrying about 1 kg, for the replay backend."""
+    rng = np.random.default_rng(seed)
+    readings = rng.normal(500000 + 200000, 200, (frames, 4)).astype(np.int32)
+    np.save(capture_file, readings)
+
+def timed(function, repeat=1):
+    """Median wall time of `function` over `repeat` calls, then its peak traced memory on one more call."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': float(np.median(times)), 'peak_bytes': peak}, result
+
+def stage_totals():
+    # The benchmark runs one scale, so its stages are summed over the scale label
+    totals = {}
+    for (scale, stage), (count, total) in instrumentation.stage_seconds.totals().items():
+        previous = totals.get(stage, (0, 0.0))
+        totals[stage] = (previous[0] + count, previous[1] + total)
+    return totals
+
+def stage_means(before, after):
+    means = {}
+    for stage, (count, total) in after.items():
+        count -= before.get(stage, (0, 0.0))[0]
+        total -= before.get(stage, (0, 0.0))[1]
+        if count:
+            means[stage] = total / count
+    return means
+
+def bench_size(size, args, workdir, capture_file):
+    from scale import Scale
+
+    results = {}
+    store_file = os.path.join(workdir, f"samples_{size}.bin")
+    store = SampleStore(store_file, size)
+    store.extend(make_history(size, args.duration))
+    store.close()
+
+    scale = Scale(backend='replay', sensor_options={'capture': capture_file, 'sample_rate': args.rate})
+    # The measuring loop prints every cycle
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            # Startup: map the store, fill the buffer and prime the rollup tiers
+            gc.collect()
+            tracemalloc.start()
+            start = time.perf_counter()
+            scale.load_samples(store_file, size)
+            results['load'] = {'seconds': time.perf_counter() - start, 'peak_bytes': tracemalloc.get_traced_memory()[1]}
+            tracemalloc.stop()
+
+            measure_args = (args.duration, 0.001, 2000000, store_file, size)
+            # The first cycle primes the incremental smoother from the whole history
+            start = time.perf_counter()
+            time_array, sample_buffer, smoothed = scale.measure(*measure_args)
+            results['first_cycle'] = {'seconds': time.perf_counter() - start, 'peak_bytes': 0}
+
+            before = stage_totals()
+            cycle_times = []
+            for _ in range(args.cycles):
+                start = time.perf_counter()
+                time_array, sample_buffer, smoothed = scale.measure(*measure_args)
+                cycle_times.append(time.perf_counter() - start)
+            gc.collect()
+            tracemalloc.start()
+            scale.measure(*measure_args)
+            cycle_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results['cycle'] = {'seconds': float(np.median(cycle_times)), 'peak_bytes': cycle_peak}
+            for stage, seconds in stage_means(before, stage_totals()).items():
+                if stage != 'collect':
+                    results[f"cycle.{stage}"] = {'seconds': seconds, 'peak_bytes': 0}
+
+            results['query'], _ = timed(lambda: scale.samples_since(0, 2000), args.repeat)
+            results['forecast'], _ = timed(lambda: scale.forecaster.report(), args.repeat)
+            # The median of three leaves out creating the figure on the first call
+            plot_file = os.path.join(workdir, "samples.png")
+            results['plot'], _ = timed(lambda: scale.plot(time_array, sample_buffer, smoothed, plot_file), 3)
+            if size <= args.full_limit:
+                window = min(int(10 * 60 / args.duration), size - 1)
+                results['smooth_full'], _ = timed(lambda: scale.smooth_full(sample_buffer, window))
+        finally:
+            scale.cleanup()
+
+        # Restart: the tiers and the snapshot written at cleanup are now on disk
+        scale = Scale(backend='replay', sensor_options={'capture': capture_file, 'sample_rate': args.rate})
+        try:
+            gc.collect()
+            tracemalloc.start()
+            start = time.perf_counter()
+            scale.load_samples(store_file, size)
+            results['restart'] = {'seconds': time.perf_counter() - start, 'peak_bytes': tracemalloc.get_traced_memory()[1]}
+            tracemalloc.stop()
+        finally:
+            scale.cleanup()
+    return results
+
+def bench_window(args):
+    """Stages that depend on the samples per window rather than on the history."""
+    from confidence import CI_METHODS, make_ci_estimator
+    from scale import warm_up
+
+    # The lazy imports, done once here so the first size's first cycle does not pay for them
+    start = time.perf_counter()
+    warm_up()
+    results = {'warm_up': {'seconds': time.perf_counter() - start, 'peak_bytes': 0}}
+    samples = np.random.default_rng(0).normal(1000, 1, int(args.rate * args.duration) or 80)
+    for method in CI_METHODS:
+        estimator = make_ci_estimator(method)
+        results[f"ci.{method}"], _ = timed(lambda: estimator(samples), args.repeat)
+    return results
+
+def check_read_filter(window=15, channels=4):
+    """Run HampelFilter over blocks following histories of every length up to the window, as interrupted blocks leave.
+
+    Returns the number of combinations checked, raising RuntimeError on a mismatched shape or a lost glitch.
+    """
+    from acquisition import HampelFilter
+
+    rng = np.random.default_rng(0)
+    checked = 0
+    for history_length in range(window + 1):
+        for block_length in (1, 2, window // 2, 80):
+            read_filter = HampelFilter(window)
+            if history_length:
+                read_filter.apply(np.zeros(history_length), rng.normal(0, 10, (history_length, channels)).astype(np.int32))
+            block = rng.normal(0, 10, (block_length, channels)).astype(np.int32)
+            if block_length >= window:
+                block[block_length // 2, 0] = 1 << 20
+            case = f"history {history_length}, block {block_length}"
+            timestamps, kept = read_filter.apply(np.arange(block_length, dtype=float), block)
+            if kept.shape[1] != channels or len(timestamps) != len(kept):
+                raise RuntimeError(f"Read filter returned {len(timestamps)} timestamps for a {kept.shape} block ({case})")
+            expected = min(history_length + block_length, read_filter.half)
+            if len(read_filter.history) != expected:
+                raise RuntimeError(f"Read filter kept {len(read_filter.history)} rows of history, expected {expected} ({case})")
+            if block_length >= window and np.any(kept[:, 0] == 1 << 20):
+                raise RuntimeError(f"Read filter let a glitch through ({case})")
+            checked += 1
+    return checked
+
+def compare(results, baseline, tolerance, min_seconds):
+    """Stages slower than `tolerance` times the baseline, ignoring differences under `min_seconds`."""
+    regressions = []
+    for size, stages in results.items():
+        for stage, result in stages.items():
+            base = baseline.get(size, {}).get(stage)
+            if base is None:
+                continue
+            if result['seconds'] > tolerance * base['seconds'] and result['seconds'] - base['seconds'] > min_seconds:
+                regressions.append((size, stage, base['seconds'], result['seconds']))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the processing pipeline on replayed data, across history sizes")
+    parser.add_argument("-n", "--sizes", type=str, default=','.join(map(str, DEFAULT_SIZES)), help="Comma separated history sizes in samples")
+    parser.add_argument("-d", "--duration", type=float, default=0.25, help="Measurement window in seconds")
+    parser.add_argument("-r", "--rate", type=float, default=80.0, help="Replay rate in samples per second")
+    parser.add_argument("-c", "--cycles", type=int, default=10, help="Measurement cycles per size")
+    parser.add_argument("--repeat", type=int, default=5, help="Repeats of each one-off stage")
+    parser.add_argument("--full-limit", type=int, default=10000, help="Largest size to run the full smoothing on")
+    parser.add_argument("--capture", type=str, default=None, help="Raw .npy capture to replay, simulated if not given")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Write the results to a JSON file")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON results to compare against, exiting with 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="Allowed slowdown against the baseline")
+    parser.add_argument("--min-seconds", type=float, default=0.002, help="Ignore slowdowns smaller than this")
+    args = parser.parse_args()
+
+    instrumentation.configure(enabled=True)
+    print(f"Read filter: {check_read_filter()} history and block lengths checked")
+    workdir = tempfile.mkdtemp(prefix="hx4-benchmark-")
+    try:
+        capture_file = args.capture
+        if capture_file is None:
+            capture_file = os.path.join(workdir, "capture.npy")
+            make_capture(capture_file)
+
+        results = {'window': bench_window(args)}
+        for size in (int(size) for size in args.sizes.split(',')):
+            results[str(size)] = bench_size(size, args, workdir, capture_file)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'size':>8} {'stage':<18} {'time (ms)':>10} {'peak (KiB)':>11}")
+    for size, stages in results.items():
+        for stage, result in stages.items():
+            peak = f"{result['peak_bytes'] / 1024:.0f}" if result['peak_bytes'] else ''
+            print(f"{size:>8} {stage:<18} {1000 * result['seconds']:>10.3f} {peak:>11}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.min_seconds)
+        for size, stage, before, after in regressions:
+            print(f"Regression: {size} {stage} {1000 * before:.3f} ms -> {1000 * after:.3f} ms")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
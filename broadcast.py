@@ -0,0 +1,41 @@
+import queue
+import threading
+
+class Broadcaster:
+    """Fan out events to any number of subscribers, each with its own bounded queue.
+
+    Publishing never blocks: a subscriber that falls behind loses its oldest events.
+    """
+
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._subscribers = []
+
+    def subscribe(self):
+        subscriber = queue.Queue(maxsize=self.maxsize)
+        with self._lock:
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def publish(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                try:
+                    subscriber.get_nowait()
+                except queue.Empty:
+                    pass
+                subscriber.put_nowait(event)
@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+import argparse
+import math
+
+import numpy as np
+
+from metrics import Counter, registry
+
+ZERO_DRIFT = registry.register(Counter(
+    'hx4_zero_drift_grams', 'Zero drift taken out by automatic re-tares since startup', 'scale', kind='gauge'))
+
+def fit_total(totals, weights):
+    """Gain and offset of weight = gain * (raw - offset), by least squares over the points."""
+    # Centring the raw totals keeps the solve well conditioned
+    center = totals.mean()
+    design = np.column_stack([totals - center, np.ones(len(totals))])
+    (gain, intercept), _, rank, _ = np.linalg.lstsq(design, weights, rcond=None)
+    if rank < 2 or gain == 0:
+        return None
+    return gain, center - intercept / gain
+
+def fit_corners(corners, weights, corner_tare):
+    """Per-corner gains of weight = sum((raw - corner_tare) * gain), or None if the points do not pin them down.
+
+    That needs the weight placed at enough different positions, say once over each corner.
+    """
+    loads = corners - corner_tare
+    gains, _, rank, _ = np.linalg.lstsq(loads, weights, rcond=None)
+    if rank < loads.shape[1] or np.any(gains <= 0):
+        return None
+    return gains
+
+class CalibrationSession:
+    """Known-weight points collected over one calibration session, refitted as each is added.
+
+    Each point keeps the median raw total and the median of each corner over its window.
+    Taring starts a new session with a zero point; without one, the configured tare stands in.
+    """
+
+    def __init__(self, channels=4):
+        self.channels = channels
+        self.weights = []
+        self.totals = []
+        self.corners = []
+
+    def __len__(self):
+        return len(self.weights)
+
+    def add(self, weight, block):
+        if not math.isfinite(weight):
+            raise ValueError(f"Calibration weight must be finite, not {weight}")
+        self.weights.append(float(weight))
+        self.totals.append(float(np.median(block.sum(axis=1, dtype=np.int64))))
+        self.corners.append(np.median(block, axis=0))
+
+    def fit(self, tare_value=0.0, corner_tare=None, per_corner=True):
+        """Scale factor, tare and per-corner factors fitted to every point, with each point's residual in grams.
+
+        The residuals are those of the weight as measure reports it: the sum of the corner
+        loads when the points were enough to fit each corner (`per_corner`), otherwise the
+        scaled total, whose residuals are also kept as `total_residuals`. Returns None until
+        the points include two different weights.
+        """
+        weights = np.array(self.weights)
+        totals = np.array(self.totals)
+        corners = np.array(self.corners, dtype=float).reshape(-1, self.channels)
+        if not np.any(weights == 0):
+            corner_zero = corner_tare if corner_tare is not None else np.full(self.channels, tare_value / self.channels)
+            weights = np.append(weights, 0.0)
+            totals = np.append(totals, tare_value)
+            corners = np.vstack([corners, corner_zero])
+        if len(np.unique(weights)) < 2:
+            return None
+
+        try:
+            fit = fit_total(totals, weights)
+            if fit is None:
+                return None
+            scale_factor, tare_value = fit
+
+            # The corners zero where the empty scale read, shifted to agree with the fitted tare
+            corner_tare = np.median(corners[weights == 0], axis=0)
+            corner_tare += (tare_value - corner_tare.sum()) / self.channels
+            corner_scale = fit_corners(corners, weights, corner_tare) if per_corner else None
+        except np.linalg.LinAlgError as e:
+            print("Calibration fit failed", e)
+            return None
+        total_residuals = (totals - tare_value) * scale_factor - weights
+        per_corner = corner_scale is not None
+        if per_corner:
+            residuals = (corners - corner_tare) @ corner_scale - weights
+        else:
+            # One factor for every corner, as a single position only fixes the total
+            corner_scale = np.full(self.channels, scale_factor)
+            residuals = total_residuals
+
+        return {
+            'scale_factor': float(scale_factor),
+            'tare_value': float(tare_value),
+            'corner_tare': corner_tare,
+            'corner_scale': corner_scale,
+            'weights': weights,
+            'residuals': residuals,
+            'rms': float(np.sqrt(np.mean(residuals**2))),
+            'total_residuals': total_residuals,
+            'per_corner': per_corner,
+        }
+
+class ZeroTracker:
+    """Automatic zero tracking, re-taring an empty scale as its zero drifts with temperature.
+
+    A window counts as empty when its weight is within `zero_band` grams of zero and its CI
+    is narrower than the band. Each corner's offset from its tare is followed over empty
+    windows with time constant `time_constant` seconds, and once the offsets, converted by
+    each corner's own gain, add up to `threshold` grams a re-tare is proposed. Loaded windows
+    are skipped, so a spool left on the scale is never tared away, and drift is only learnt
+    while the scale is empty.
+    """
+
+    def __init__(self, zero_band=5.0, threshold=0.2, time_constant=600.0, name=None):
+        self.zero_band = zero_band
+        self.threshold = threshold
+        self.time_constant = time_constant
+        self.label = name or 'default'
+        self.offsets = None
+        self.timestamp = None
+        self.drift = 0.0
+
+    def update(self, timestamp, weight, ci, corner_medians, tare_value, corner_tare, corner_scale):
+        """Follow an empty window, returning the new (tare_value, corner_tare) when a re-tare is due."""
+        if not (abs(weight) <= self.zero_band and ci < self.zero_band):
+            return None
+        offsets = corner_medians - corner_tare
+        if self.offsets is None or timestamp - self.timestamp > self.time_constant:
+            self.offsets = offsets
+        else:
+            alpha = 1.0 - math.exp(-(timestamp - self.timestamp) / self.time_constant)
+            self.offsets = self.offsets + alpha * (offsets - self.offsets)
+        self.timestamp = timestamp
+
+        drift = float(self.offsets @ corner_scale)
+        if abs(drift) < self.threshold:
+            return None
+        corner_tare = corner_tare + self.offsets
+        tare_value = tare_value + self.offsets.sum()
+        self.offsets = np.zeros_like(self.offsets)
+        self.drift += drift
+        ZERO_DRIFT.set(round(self.drift, 3), label=self.label)
+        return tare_value, corner_tare
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the calibration fit recovers simulated corner gains")
+    parser.add_argument("-w", "--weights", type=str, default="0,200,500,1000,500,500,500", help="Comma separated known weights in grams")
+    parser.add_argument("-n", "--noise", type=float, default=50.0, help="Standard deviation of the raw readings")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    gains = np.array([0.0048, 0.0052, 0.0050, 0.0047])
+    zero = np.array([480000.0, 510000.0, 495000.0, 505000.0])
+    session = CalibrationSession()
+    weights = [float(weight) for weight in args.weights.split(',')]
+    for index, weight in enumerate(weights):
+        # The first four points sit in the middle of the platform, later ones over one corner after another
+        share = np.full(4, 0.25) if index < 4 else np.eye(4)[index % 4] * 0.7 + 0.075
+        raw = zero + weight * share / gains
+        session.add(weight, rng.normal(raw, args.noise, (400, 4)).astype(np.int32))
+        fit = session.fit()
+        if fit is not None:
+            total_rms = f" by corner, {np.sqrt(np.mean(fit['total_residuals']**2)):.3f} g by total" if fit['per_corner'] else ''
+            print(f"{len(session)} points: scale factor {fit['scale_factor']:.6g}, tare {fit['tare_value']:.0f}, "
+                  f"RMS residual {fit['rms']:.3f} g{total_rms}, corner scale {np.array2string(fit['corner_scale'], precision=5)}")
+    print(f"True scale factor for a centred load {1 / np.mean(1 / gains):.6g}, corner gains {gains}")
+
+if __name__ == "__main__":
+    main()
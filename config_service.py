@@ -0,0 +1,94 @@
+import configparser
+import os
+import threading
+
+import numpy as np
+
+class ConfigService:
+    """The single in-memory copy of scale_config.ini, shared by the measuring loop and the HTTP server.
+
+    The file is read once. Updates are applied under a lock, and written back with
+    write-to-temp-then-rename only when a value actually changed. Each scale reads its
+    own `[scale:<name>]` section through a view sharing the same parser and lock, with
+    anything not set there falling back to `[DEFAULT]`.
+    """
+
+    def __init__(self, config_file='scale_config.ini', section='DEFAULT', config=None, lock=None):
+        self.config_file = config_file
+        self.section = section
+        self._lock = lock if lock is not None else threading.RLock()
+        if config is None:
+            config = configparser.ConfigParser()
+            config.read(config_file)
+        self.config = config
+        if section != 'DEFAULT' and not self.config.has_section(section):
+            self.config.add_section(section)
+
+    def view(self, section):
+        """A ConfigService for another section of the same file."""
+        return ConfigService(self.config_file, section, self.config, self._lock)
+
+    def scale_names(self):
+        """Names of the scales defined as [scale:<name>] sections, in file order."""
+        with self._lock:
+            return [section.split(':', 1)[1] for section in self.config.sections() if section.startswith('scale:')]
+
+    def is_default(self, option):
+        """Whether the option's value is the one inherited from [DEFAULT]."""
+        with self._lock:
+            return self.config.get(self.section, option, fallback=None) == self.config.defaults().get(option)
+
+    def get(self, option, fallback=None):
+        with self._lock:
+            return self.config.get(self.section, option, fallback=fallback)
+
+    def getfloat(self, option, fallback=None):
+        with self._lock:
+            try:
+                return self.config.getfloat(self.section, option)
+            except (configparser.NoSectionError, configparser.NoOptionError, ValueError):
+                return fallback
+
+    def getint(self, option, fallback=None):
+        with self._lock:
+            try:
+                return self.config.getint(self.section, option)
+            except (configparser.NoSectionError, configparser.NoOptionError, ValueError):
+                return fallback
+
+    def getboolean(self, option, fallback=None):
+        with self._lock:
+            try:
+                return self.config.getboolean(self.section, option)
+            except (configparser.NoSectionError, configparser.NoOptionError, ValueError):
+                return fallback
+
+    def getfloats(self, option, fallback=None):
+        """A comma separated list of floats, such as the per-corner tare values."""
+        with self._lock:
+            try:
+                return [float(value) for value in self.config.get(self.section, option).split(',')]
+            except (configparser.NoSectionError, configparser.NoOptionError, ValueError):
+                return fallback
+
+    def update(self, **values):
+        """Set several options at once, persisting them if any changed. Returns whether they did."""
+        with self._lock:
+            changed = False
+            for option, value in values.items():
+                if isinstance(value, (list, tuple, np.ndarray)):
+                    value = ','.join(repr(float(item)) for item in value)
+                value = str(value)
+                if self.config.get(self.section, option, fallback=None) != value:
+                    self.config[self.section][option] = value
+                    changed = True
+            if changed:
+                self.save()
+            return changed
+
+    def save(self):
+        with self._lock:
+            tmp_file = self.config_file + ".tmp"
+            with open(tmp_file, 'w') as configfile:
+                self.config.write(configfile)
+            os.replace(tmp_file, self.config_file)
@@ -0,0 +1,106 @@
+import numpy as np
+
+from metrics import Counter, registry, scale_label
+
+# Positions of the four load cells, in acquisition order, on a normalised -1..1 platform
+CORNER_POSITIONS = np.array([(-1.0, -1.0), (1.0, -1.0), (1.0, 1.0), (-1.0, 1.0)])
+
+# The HX711 clips its 24 bit two's complement output at these values
+HX711_MAX = 0x7FFFFF
+HX711_MIN = -0x800000
+
+CORNER_FAULTS = registry.register(Counter(
+    'hx4_corner_fault', 'Load cell fault in the last window: 0 ok, 1 stuck, 2 saturated', ('scale', 'sensor'), kind='gauge'))
+CORNER_DRIFT = registry.register(Counter(
+    'hx4_corner_drift_per_minute', 'Slope of each corner\'s load over the last window, in units per minute', ('scale', 'sensor'), kind='gauge'))
+
+def corner_factors(values, total, channels=4, share=True):
+    """Per-corner values from config, falling back to the total split evenly (or repeated)."""
+    if values is not None and len(values) == channels:
+        return np.asarray(values, dtype=float)
+    return np.full(channels, total / channels if share else total, dtype=float)
+
+def corner_loads(block, corner_tare, corner_scale):
+    """Convert an (n, corners) block of raw readings to per-corner weights."""
+    return (block - corner_tare) * corner_scale
+
+def center_of_mass(loads, positions=CORNER_POSITIONS):
+    """Load-weighted mean position of each row of `loads`, NaN where the total is not positive."""
+    total = loads.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        center = (loads @ positions) / total[..., None]
+    center[total <= 0] = np.nan
+    return center
+
+def corner_drift(timestamps, loads):
+    """Least-squares slope of each corner's load over the window, in units per minute."""
+    if len(timestamps) < 2:
+        return np.zeros(loads.shape[1])
+    t = timestamps - timestamps.mean()
+    denominator = t @ t
+    if denominator == 0:
+        return np.zeros(loads.shape[1])
+    return 60.0 * (t @ (loads - loads.mean(axis=0))) / denominator
+
+def saturated_corners(block):
+    return ((block >= HX711_MAX) | (block <= HX711_MIN)).any(axis=0)
+
+class CornerMonitor:
+    """Tracks the spread of each load cell across windows and flags failing cells.
+
+    A cell is stuck when its readings stop varying: a standard deviation below `min_std`
+    counts, or below `collapse_ratio` of its own long-run average. A cell is saturated
+    when any reading hits the HX711's output limits.
+    """
+
+    def __init__(self, channels=4, min_std=0.5, collapse_ratio=0.05, alpha=0.05, name=None):
+        self.labels = [f"{name}:{index}" if name else str(index) for index in range(channels)]
+        self.metric_labels = [(scale_label(name), str(index)) for index in range(channels)]
+        self.min_std = min_std
+        self.collapse_ratio = collapse_ratio
+        self.alpha = alpha
+        self.baseline_std = np.full(channels, np.nan)
+        self.stuck = np.zeros(channels, dtype=bool)
+        self.saturated = np.zeros(channels, dtype=bool)
+
+    def update(self, block, drift=None):
+        std = block.std(axis=0) if len(block) > 1 else np.full(block.shape[1], np.nan)
+        with np.errstate(invalid='ignore'):
+            stuck = (std < self.min_std) | (std < self.collapse_ratio * self.baseline_std)
+        saturated = saturated_corners(block)
+
+        # Only learn the baseline from healthy windows, so a failing cell does not drag it down
+        healthy = ~stuck & ~saturated & np.isfinite(std)
+        first = healthy & np.isnan(self.baseline_std)
+        self.baseline_std[first] = std[first]
+        learn = healthy & ~first
+        self.baseline_std[learn] += self.alpha * (std[learn] - self.baseline_std[learn])
+
+        for index in np.flatnonzero((stuck & ~self.stuck) | (saturated & ~self.saturated)):
+            problem = 'saturated' if saturated[index] else 'stuck'
+            print(f"Load cell {self.labels[index]} looks {problem} (std {std[index]:.1f})")
+        for index, label in enumerate(self.metric_labels):
+            CORNER_FAULTS.set(2 if saturated[index] else 1 if stuck[index] else 0, label=label)
+            if drift is not None:
+                CORNER_DRIFT.set(round(float(drift[index]), 4), label=label)
+
+        self.stuck = stuck
+        self.saturated = saturated
+        return self.faults()
+
+    def faults(self):
+        return ['saturated' if saturated else 'stuck' if stuck else 'ok'
+                for stuck, saturated in zip(self.stuck, self.saturated)]
+
+def analyze_window(timestamps, block, corner_tare, corner_scale, monitor=None):
+    """Vectorised per-corner summary of one measurement window."""
+    loads = corner_loads(block, corner_tare, corner_scale)
+    medians = np.median(loads, axis=0)
+    summary = {
+        'corners': medians,
+        'center': center_of_mass(medians),
+        'drift': corner_drift(timestamps, loads),
+    }
+    if monitor is not None:
+        summary['faults'] = monitor.update(block, summary['drift'])
+    return summary
@@ -0,0 +1,262 @@
+#!/usr/bin/python3
+import argparse
+import math
+import time
+
+import numpy as np
+
+from smoothing import MAD_TO_SIGMA
+
+def metres_per_gram(density_gcm3=1.07, diameter_mm=1.75):
+    """Length of filament per gram, from its density and diameter."""
+    radius_cm = diameter_mm / 2.0 / 10.0
+    volume_per_cm = np.pi * radius_cm**2
+    return 1 / (volume_per_cm * density_gcm3) / 100.0
+
+class RobustTrend:
+    """Exponentially weighted least squares line through (time, weight), updated in O(1).
+
+    Older points are down-weighted with time constant `time_constant` seconds. A point whose
+    residual exceeds `outlier_sigma` times the running noise estimate is rejected, unless
+    `max_rejections` arrive in a row, which is taken as a step (a spool change, a hand on the
+    scale) and restarts the fit from the new level.
+    """
+
+    def __init__(self, time_constant=600.0, outlier_sigma=4.0, warmup=10, max_rejections=5):
+        self.time_constant = time_constant
+        self.outlier_sigma = outlier_sigma
+        self.warmup = warmup
+        self.max_rejections = max_rejections
+        self.rejected = 0
+        self.reset()
+
+    def reset(self):
+        # Sums of weights, and of squared weights, with times relative to the newest point
+        self.t_ref = None
+        self.s0 = self.st = self.stt = self.sy = self.sty = 0.0
+        self.q0 = self.qt = self.qtt = 0.0
+        self.abs_residual = 0.0
+        self.count = 0
+        self.consecutive_rejections = 0
+
+    def _advance(self, t):
+        dt = t - self.t_ref
+        # Move the time origin to t, then age the sums
+        self.stt += -2 * dt * self.st + dt * dt * self.s0
+        self.st -= dt * self.s0
+        self.sty -= dt * self.sy
+        self.qtt += -2 * dt * self.qt + dt * dt * self.q0
+        self.qt -= dt * self.q0
+        decay = math.exp(-dt / self.time_constant)
+        self.s0 *= decay
+        self.st *= decay
+        self.stt *= decay
+        self.sy *= decay
+        self.sty *= decay
+        self.q0 *= decay * decay
+        self.qt *= decay * decay
+        self.qtt *= decay * decay
+        self.t_ref = t
+
+    SNAPSHOT = ('s0', 'st', 'stt', 'sy', 'sty', 'q0', 'qt', 'qtt', 'abs_residual', 'count', 'rejected')
+
+    def snapshot(self):
+        snapshot = {name: getattr(self, name) for name in self.SNAPSHOT}
+        snapshot['t_ref'] = np.nan if self.t_ref is None else self.t_ref
+        return snapshot
+
+    def restore(self, snapshot):
+        for name in self.SNAPSHOT:
+            setattr(self, name, snapshot[name].item())
+        t_ref = float(snapshot['t_ref'])
+        self.t_ref = None if np.isnan(t_ref) else t_ref
+
+    def update(self, t, y):
+        """Add a point, returning False if it was rejected as an outlier."""
+        if self.t_ref is None:
+            self.t_ref = t
+        self._advance(t)
+
+        if self.count >= 2:
+            residual = y - self.level
+            sigma = self.sigma
+            if self.count >= self.warmup and sigma > 0 and abs(residual) > self.outlier_sigma * sigma:
+                self.rejected += 1
+                self.consecutive_rejections += 1
+                if self.consecutive_rejections < self.max_rejections:
+                    return False
+                self.reset()
+                self.t_ref = t
+            else:
+                self.abs_residual += 0.05 * (abs(residual) - self.abs_residual)
+        self.consecutive_rejections = 0
+
+        self.s0 += 1.0
+        self.sy += y
+        self.q0 += 1.0
+        self.count += 1
+        return True
+
+    @property
+    def sigma(self):
+        return MAD_TO_SIGMA * self.abs_residual
+
+    @property
+    def _sxx(self):
+        return self.stt - self.st * self.st / self.s0 if self.s0 > 0 else 0.0
+
+    @property
+    def slope(self):
+        """Weight change per second."""
+        sxx = self._sxx
+        if sxx <= 1e-12 * max(self.stt, 1.0):
+            return 0.0
+        return (self.sty - self.st * self.sy / self.s0) / sxx
+
+    @property
+    def level(self):
+        """Fitted weight at the newest point."""
+        if self.s0 <= 0:
+            return np.nan
+        return (self.sy - self.slope * self.st) / self.s0
+
+    @property
+    def slope_std(self):
+        sxx = self._sxx
+        if sxx <= 1e-12 * max(self.stt, 1.0):
+            return np.inf
+        t_mean = self.st / self.s0
+        spread = self.qtt - 2 * t_mean * self.qt + t_mean * t_mean * self.q0
+        return self.sigma * math.sqrt(max(spread, 0.0)) / sxx
+
+    @property
+    def level_std(self):
+        if self.s0 <= 0:
+            return np.inf
+        t_mean = self.st / self.s0
+        slope_std = self.slope_std if np.isfinite(self.slope_std) else 0.0
+        return math.sqrt(self.sigma**2 * self.q0 / self.s0**2 + (t_mean * slope_std)**2)
+
+class SpoolForecaster:
+    """Remaining filament and time to empty, from the trend of the spool's weight.
+
+    The spool is printing while the weight falls faster than `min_rate` grams per hour and
+    the fall is significant at `z` standard errors, and idle otherwise. A change of state
+    only counts after `hold` consecutive updates agree.
+    """
+
+    def __init__(self, time_constant=600.0, min_rate=1.0, z=2.0, hold=3):
+        self.trend = RobustTrend(time_constant)
+        self.min_rate = min_rate
+        self.z = z
+        self.hold = hold
+        self.state = 'unknown'
+        self.state_since = None
+        self.timestamp = None
+        self._pending = 0
+
+    def prime(self, timestamps, weights):
+        """Catch up from recent history after a restart."""
+        if len(timestamps) == 0:
+            return
+        recent = timestamps >= timestamps[-1] - 5 * self.trend.time_constant
+        for t, y in zip(timestamps[recent].tolist(), weights[recent].tolist()):
+            self.update(t, y)
+
+    def snapshot(self):
+        """Scalars that `restore` continues from, with NaN for unknown times."""
+        snapshot = {f"trend_{name}": value for name, value in self.trend.snapshot().items()}
+        snapshot['state'] = self.state
+        snapshot['state_since'] = np.nan if self.state_since is None else self.state_since
+        snapshot['timestamp'] = np.nan if self.timestamp is None else self.timestamp
+        return snapshot
+
+    def restore(self, snapshot):
+        self.trend.restore({name[len('trend_'):]: value for name, value in snapshot.items() if name.startswith('trend_')})
+        self.state = str(snapshot['state'])
+        self.state_since = None if np.isnan(snapshot['state_since']) else float(snapshot['state_since'])
+        self.timestamp = None if np.isnan(snapshot['timestamp']) else float(snapshot['timestamp'])
+
+    def update(self, timestamp, weight):
+        if not math.isfinite(weight):
+            return
+        self.trend.update(timestamp, weight)
+        self.timestamp = timestamp
+        if self.trend.count < self.trend.warmup:
+            return
+
+        rate = -self.trend.slope * 3600
+        printing = rate > self.min_rate and rate > self.z * self.trend.slope_std * 3600
+        candidate = 'printing' if printing else 'idle'
+        if self.state == 'unknown':
+            self.state, self.state_since = candidate, timestamp
+        elif candidate != self.state:
+            self._pending += 1
+            if self._pending >= self.hold:
+                self.state, self.state_since = candidate, timestamp
+                self._pending = 0
+        else:
+            self._pending = 0
+
+    def report(self, density_gcm3=1.07, diameter_mm=1.75, empty_weight=0.0):
+        """The current forecast as a JSON-friendly dict, None where a value is unknown."""
+        trend = self.trend
+        def value(x, digits=3):
+            return round(float(x), digits) if x is not None and np.isfinite(x) else None
+
+        remaining = trend.level - empty_weight
+        rate = -trend.slope
+        result = {
+            'timestamp': self.timestamp,
+            'state': self.state,
+            'state_since': self.state_since,
+            'weight': value(trend.level),
+            'remaining_g': value(remaining, 1),
+            'remaining_m': value(remaining * metres_per_gram(density_gcm3, diameter_mm), 1),
+            'rate_g_per_h': value(rate * 3600),
+            'rate_std_g_per_h': value(trend.slope_std * 3600),
+            'rejected': trend.rejected,
+            'empty_in': None,
+            'empty_in_low': None,
+            'empty_in_high': None,
+            'empty_at': None,
+        }
+        if self.state == 'printing' and rate > 0 and remaining > 0:
+            seconds = remaining / rate
+            relative = np.hypot(trend.level_std / remaining, trend.slope_std / rate)
+            spread = 1.96 * seconds * relative
+            result['empty_in'] = value(seconds, 0)
+            result['empty_in_low'] = value(max(seconds - spread, 0.0), 0)
+            result['empty_in_high'] = value(seconds + spread, 0) if relative < 1 / 1.96 else None
+            result['empty_at'] = value(self.timestamp + seconds, 0)
+        return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the forecaster on a simulated print, and time its updates")
+    parser.add_argument("-n", "--number", type=int, default=20000, help="Samples to simulate, one per second")
+    parser.add_argument("-r", "--rate", type=float, default=20.0, help="Filament use while printing, in g/h")
+    args = parser.parse_args()
+
+    # Idle for the first quarter, then printing, with noise and the odd outlier
+    rng = np.random.default_rng(0)
+    t = 1.7e9 + np.arange(args.number, dtype=float)
+    printing = t >= t[args.number // 4]
+    weights = 800 - np.cumsum(printing) * args.rate / 3600 + rng.normal(0, 0.3, args.number)
+    weights[rng.random(args.number) < 0.002] += 40
+
+    forecaster = SpoolForecaster()
+    start = time.perf_counter()
+    for timestamp, weight in zip(t, weights):
+        forecaster.update(timestamp, weight)
+    elapsed = time.perf_counter() - start
+    report = forecaster.report()
+
+    true_seconds = (weights[-1] - 0) / (args.rate / 3600)
+    print(f"{1e6 * elapsed / args.number:.1f} us per update")
+    print(f"State {report['state']} since sample {int(report['state_since'] - t[0])} (printing began at {args.number // 4})")
+    print(f"Rate {report['rate_g_per_h']} +/- {report['rate_std_g_per_h']} g/h (true {args.rate})")
+    print(f"Empty in {report['empty_in']} s [{report['empty_in_low']}, {report['empty_in_high']}] (true {true_seconds:.0f} s)")
+    print(f"{report['rejected']} outliers rejected")
+
+if __name__ == "__main__":
+    main()
@@ -1,92 +1,381 @@
 import os
-import configparser
+import gzip
+import hashlib
+import json
+import math
+import queue
+import threading
+import time
 import http.server
 import socket
 import socketserver
 import urllib
 from urllib.parse import urlparse, parse_qs
-from states import STATE_TARING, STATE_CALIBRATING, STATE_MEASURING, STATE_CLEARING
+import numpy as np
+from states import STATE_TARING, STATE_CALIBRATING, STATE_CLEARING
+from metrics import Counter, Histogram, registry, scale_label, startup
 
 socketserver.allow_reuse_address = True
 socketserver.TCPServer.allow_reuse_address = True
 
+REQUEST_LATENCY = registry.register(Histogram(
+    'hx4_http_request_duration_seconds', 'Time spent handling HTTP requests', 'path'))
+REJECTED_CONNECTIONS = registry.register(Counter(
+    'hx4_http_rejected_total', 'Connections and event streams turned away with 503 at their cap', 'reason'))
+
+# Sent straight to the socket when every connection slot is taken, without a handler thread
+BUSY_RESPONSE = (b"HTTP/1.1 503 Service Unavailable\r\nContent-Type: text/plain\r\nContent-Length: 12\r\n"
+                 b"Retry-After: 5\r\nConnection: close\r\n\r\nServer busy\n")
+
+API_ROUTES = ('/api/samples', '/api/forecast', '/api/calibration', '/api/scales', '/api/status', '/metrics', '/tare', '/calibrate', '/clear')
+
+class StaticCache:
+    """In-memory cache of static files with an ETag and a precompressed gzip copy.
+
+    Entries are revalidated against the file's modification time and size, so a chart
+    rewritten on disk is picked up on the next request.
+    """
+
+    def __init__(self, max_size=8 * 1024 * 1024):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, path, content_type):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if stat.st_size > self.max_size:
+            return None
+
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry['key'] == key:
+                return entry
+
+        with open(path, 'rb') as f:
+            body = f.read()
+        compressed = gzip.compress(body, compresslevel=6)
+        entry = {
+            'key': key,
+            'body': body,
+            # Only keep the gzip copy when it is worth the client decompressing it
+            'gzip': compressed if len(compressed) < 0.9 * len(body) else None,
+            'etag': '"' + hashlib.sha1(body).hexdigest()[:20] + '"',
+            'content_type': content_type,
+        }
+        with self._lock:
+            self._entries[path] = entry
+        return entry
+
+class ScaleHTTPServer(http.server.ThreadingHTTPServer):
+    """Thread per connection HTTP server with a cap on concurrent connections.
+
+    Connections over the cap are answered 503 and closed at once, so the accept loop never
+    waits. Event streams hold their connection for as long as the page is open, so they have
+    a smaller cap of their own, leaving slots for the tare, calibrate and clear requests.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler, max_connections=32, max_streams=8):
+        super().__init__(server_address, handler)
+        self.connection_slots = threading.BoundedSemaphore(max_connections)
+        self.stream_slots = threading.BoundedSemaphore(max(1, min(max_streams, max_connections - 1)))
+        self.static_cache = StaticCache()
+
+    def process_request(self, request, client_address):
+        if not self.connection_slots.acquire(blocking=False):
+            REJECTED_CONNECTIONS.inc(label='connections')
+            try:
+                request.sendall(BUSY_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self.connection_slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.connection_slots.release()
+
 class CustomHandler(http.server.SimpleHTTPRequestHandler):
-    def __init__(self, *args, state_q=None, config_file='scale_config.ini',**kwargs):
-        self.state_q = state_q
-        
-        self.config_file = config_file
-        self.config = configparser.ConfigParser()
-        self.config.read(self.config_file)
-        
+    # HTTP/1.1 keeps connections alive between requests; idle connections time out
+    protocol_version = 'HTTP/1.1'
+    timeout = 30
+
+    def __init__(self, *args, scales=None, **kwargs):
+        # ScaleHandles by name; the first also answers the routes without a /scale/<name> prefix
+        self.scales = scales or {}
+        self.use_scale(next(iter(self.scales.values()), None))
         super().__init__(*args, **kwargs)
 
+    def use_scale(self, handle):
+        self.scale_handle = handle
+        self.scale = handle.scale if handle else None
+        self.commands = handle.commands if handle else None
+        self.renderer = handle.renderer if handle else None
+
+    def select_scale(self):
+        """Strip a /scale/<name> prefix from the path and select that scale.
+
+        Returns False once an error or redirect has been sent instead.
+        """
+        self.use_scale(next(iter(self.scales.values()), None))
+        if not self.path.startswith('/scale/'):
+            return True
+        name, slash, rest = self.path[len('/scale/'):].partition('/')
+        name, question, query = name.partition('?')
+        handle = self.scales.get(urllib.parse.unquote(name))
+        if handle is None:
+            self.send_error(404, "Unknown scale")
+            return False
+        if not slash:
+            # Relative links in the page need the trailing slash
+            self.send_response(301)
+            self.send_header('Location', f"/scale/{name}/{question}{query}")
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return False
+        self.use_scale(handle)
+        self.path = '/' + rest
+        return True
+
     def end_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
         super().end_headers()
 
-    def do_GET(self):       
+    def do_GET(self):
+        start = time.perf_counter()
+        route = self.route_GET() if self.select_scale() else 'other'
+        if route is not None:
+            REQUEST_LATENCY.observe(time.perf_counter() - start, route)
+
+    def do_POST(self):
+        start = time.perf_counter()
+        if self.select_scale():
+            self.route_POST()
+        route = self.path if self.path in API_ROUTES else 'other'
+        REQUEST_LATENCY.observe(time.perf_counter() - start, route)
+
+    def route_GET(self):
+        # Returns the route label for the latency metrics, or None for long-lived streams
         parsed_path = urlparse(self.path)
         self.path = parsed_path.path
+        query = parse_qs(parsed_path.query)
+
+        if self.path == '/api/samples':
+            self.send_samples(query)
+            return self.path
+
+        elif self.path == '/api/forecast':
+            # Kept up to date by each measurement, so nothing is recomputed here
+            forecast = self.scale.forecast if self.scale is not None else None
+            self.send_body(json.dumps(forecast).encode('utf-8'), 'application/json')
+            return self.path
+
+        elif self.path == '/api/calibration':
+            self.send_calibration()
+            return self.path
+
+        elif self.path == '/api/stream':
+            self.send_stream()
+            return None
+
+        elif self.path == '/api/scales':
+            names = [name for name in self.scales if name is not None]
+            self.send_body(json.dumps(names).encode('utf-8'), 'application/json')
+            return self.path
+
+        elif self.path == '/api/status':
+            # Each scale is 'initialising' until its sensors are reset, then 'ready'
+            status = {scale_label(name): handle.status for name, handle in self.scales.items()}
+            self.send_body(json.dumps(status).encode('utf-8'), 'application/json')
+            return self.path
 
-        if self.path == '/':
+        elif self.path == '/metrics':
+            self.send_body(registry.render().encode('utf-8'), 'text/plain; version=0.0.4')
+            return self.path
+
+        elif self.path == '/':
             self.path = '/index.html'
-            return super().do_GET()
-        
-        else:
+
+        elif self.path.endswith('.png') and self.renderer is not None:
+            # Let the renderer know someone is watching the chart
+            self.renderer.mark_requested()
+
+        self.send_static()
+        return 'static'
+
+    def send_static(self):
+        path = self.translate_path(self.path)
+        entry = None
+        if os.path.isfile(path):
+            entry = self.server.static_cache.get(path, self.guess_type(path))
+        if entry is None:
+            # Directories, missing and very large files get the default handling
             return super().do_GET()
 
-    def do_POST(self):
+        if entry['etag'] in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            self.send_header('ETag', entry['etag'])
+            self.end_headers()
+            return
+
+        body = entry['body']
+        use_gzip = entry['gzip'] is not None and 'gzip' in self.headers.get('Accept-Encoding', '')
+        headers = {'ETag': entry['etag'], 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+        if use_gzip:
+            body = entry['gzip']
+            headers['Content-Encoding'] = 'gzip'
+        self.send_body(body, entry['content_type'], headers)
+
+    def send_body(self, body, content_type, headers=None):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_unavailable(self):
+        # A scale still resetting its sensors will answer shortly, so say so
+        if self.scale_handle is not None:
+            return self.send_error(503, "Scale initialising")
+        return self.send_error(503, "Scale not available")
+
+    def send_calibration(self):
+        # The last fit of the calibration session, with each point's residual
+        fit = self.scale.calibration_fit if self.scale is not None else None
+        if fit is not None:
+            fit = {name: value.tolist() if isinstance(value, np.ndarray) else value for name, value in fit.items()}
+        self.send_body(json.dumps(fit).encode('utf-8'), 'application/json')
+
+    def send_samples(self, query):
+        # History newer than `since`, as JSON columns or packed float32 rows
+        if self.scale is None:
+            return self.send_unavailable()
+        try:
+            since = float(query.get('since', [0])[0])
+            max_points = int(query.get('max_points', [2000])[0])
+        except ValueError:
+            return self.send_error(400, "Invalid since or max_points")
+        records, smoothed, tier = self.scale.samples_since(since, max_points)
+
+        if query.get('format', ['json'])[0] == 'f32':
+            # Timestamps are sent relative to a base, as float32 cannot hold epoch seconds precisely
+            base = float(records['timestamp'][0]) if len(records) else since
+            rows = np.column_stack([records['timestamp'] - base, records['median'], records['ci'], smoothed])
+            return self.send_body(rows.astype('<f4').tobytes(), 'application/octet-stream', {
+                'X-Base-Timestamp': repr(base),
+                'X-Columns': 'timestamp,median,ci,smoothed',
+                'X-Tier': str(tier),
+            })
+
+        body = json.dumps({
+            'timestamp': np.round(records['timestamp'], 3).tolist(),
+            'median': records['median'].tolist(),
+            'ci': np.nan_to_num(records['ci']).tolist(),
+            'smoothed': np.round(smoothed, 3).tolist(),
+            'tier': tier,
+        }, separators=(',', ':')).encode('utf-8')
+        return self.send_body(body, 'application/json')
+
+    def send_stream(self):
+        # Server-Sent Events, one event per measurement window
+        if self.scale is None:
+            return self.send_unavailable()
+        if not self.server.stream_slots.acquire(blocking=False):
+            REJECTED_CONNECTIONS.inc(label='streams')
+            return self.send_error(503, "Too many event streams")
+        try:
+            self.stream_events()
+        finally:
+            self.server.stream_slots.release()
+
+    def stream_events(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        # The stream has no length, so it ends by closing the connection
+        self.send_header('Connection', 'close')
+        self.close_connection = True
+        self.end_headers()
+
+        subscriber = self.scale.events.subscribe()
+        try:
+            while True:
+                try:
+                    event = subscriber.get(timeout=15)
+                    message = f"data: {json.dumps(event)}\n\n"
+                except queue.Empty:
+                    # Comment line to keep the connection alive through proxies
+                    message = ": keep-alive\n\n"
+                self.wfile.write(message.encode('utf-8'))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.scale.events.unsubscribe(subscriber)
+
+    def send_text(self, message):
+        self.send_body(message.encode('utf-8'), 'text/plain; charset=utf-8')
+
+    def route_POST(self):
         if self.path == '/tare':
             print("Taring")
-            while not self.state_q.empty(): self.state_q.get()
-            self.state_q.put(STATE_TARING)
-            
-            content_length = int(self.headers['Content-Length'])
+            content_length = int(self.headers.get('Content-Length', 0))
             post_data = self.rfile.read(content_length)
-            
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(b"Taring complete.")
+
+            # Interrupts the measurement window in progress
+            self.commands.put(STATE_TARING)
+            self.send_text("Taring requested.")
 
         elif self.path == '/calibrate':
             print("Calibrating")
 
-            # Write the target weight to the config
-            content_length = int(self.headers['Content-Length'])
+            content_length = int(self.headers.get('Content-Length', 0))
             post_data = self.rfile.read(content_length)
             data = urllib.parse.parse_qs(post_data.decode('utf-8'))
-            known_weight = float(data.get('weight', [1])[0])  # Default weight 1 unit
-            self.config['DEFAULT']['calibrate'] = str(known_weight)
-            with open(self.config_file, 'w') as configfile:
-                self.config.write(configfile)
+            try:
+                known_weight = float(data.get('weight', [1])[0])  # Default weight 1 unit
+            except ValueError:
+                return self.send_error(400, "Invalid weight")
+            if not math.isfinite(known_weight):
+                return self.send_error(400, "Invalid weight")
 
-            while not self.state_q.empty(): self.state_q.get()
-            self.state_q.put(STATE_CALIBRATING)
-            
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(b"Calibration complete.")
+            # The state machine stores the target weight with the new scale factor
+            self.commands.put(STATE_CALIBRATING, weight=known_weight)
+            self.send_text("Calibration requested.")
         
         elif self.path == "/clear":
             print("Clearing")
-            
-            while not self.state_q.empty(): self.state_q.get()
-            self.state_q.put(STATE_CLEARING)
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(b"Clear complete.")
+            self.commands.put(STATE_CLEARING)
+            self.send_text("Clear requested.")
             
         else:
             self.send_error(404, "Unsupported operation")
             
     
 
-def start_http_server(host, port, directory, state_q):
+def start_http_server(host, port, directory, handles, max_connections=32, max_streams=8):
+    scales = {handle.name: handle for handle in handles}
+
     def handler(*args, **kwargs):
-        return CustomHandler(*args, state_q=state_q, **kwargs)
+        return CustomHandler(*args, scales=scales, directory=directory, **kwargs)
 
-    with socketserver.TCPServer((host, port), handler) as httpd:
+    # One thread per connection, so an open event stream does not block other clients
+    with ScaleHTTPServer((host, port), handler, max_connections, max_streams) as httpd:
         httpd.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         print(f"Serving at http://{host}:{port}")
-        os.chdir(directory)
+        startup.mark('http')
         httpd.serve_forever()
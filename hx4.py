@@ -1,10 +1,13 @@
 #!/usr/bin/python3
 import argparse
-import configparser
 import os
 import signal
+import sys
 import traceback
 
+# Imported first, so the startup report's clock starts with the process
+from metrics import instrumentation, scale_label, startup
+
 from collections import deque
 import numpy as np
 
@@ -14,43 +17,47 @@ import http.server
 import socket
 import socketserver
 import threading
-import queue
 
-from scale import Scale
+from scale import Scale, warm_up
+from sensors import SENSOR_BACKENDS, DEFAULT_PINS, parse_pins, release_gpio
+from acquisition import AcquisitionScheduler
+from shared_frames import FrameRing, SharedFrames
+from rollup import parse_tiers
+from confidence import CI_METHODS
+from renderer import ChartRenderer
 from http_server import start_http_server  # Import the server start function
-from states import STATE_TARING, STATE_CALIBRATING, STATE_MEASURING, STATE_CLEARING
-
-def safe_getfloat(config, section, option, fallback):
-    """Safely get a float value from the config, providing a fallback if necessary."""
-    try:
-        return config.getfloat(section, option)
-    except (configparser.NoSectionError, configparser.NoOptionError):
-        return fallback
+from config_service import ConfigService
+from states import STATE_TARING, STATE_CALIBRATING, STATE_MEASURING, STATE_CLEARING, CommandQueue, ScaleHandle
 
 def load_config_and_parse_args():
-    config = configparser.ConfigParser()
     config_file = 'scale_config.ini'
-    config.read(config_file)  # Load the configuration file
+    settings = ConfigService(config_file)  # Load the configuration file once
     
     # Ensure defaults are set for scale_factor and tare_value
-    if 'scale_factor' not in config['DEFAULT'] or not config['DEFAULT']['scale_factor'].replace('.', '', 1).isdigit():
-        config['DEFAULT']['scale_factor'] = '1'  # Default value
+    if settings.getfloat('scale_factor') is None:
+        settings.update(scale_factor=1)  # Default value
     
-    if 'tare_value' not in config['DEFAULT'] or not config['DEFAULT']['tare_value'].replace('.', '', 1).lstrip('-').isdigit():
-        config['DEFAULT']['tare_value'] = '0'  # Default value
+    if settings.getfloat('tare_value') is None:
+        settings.update(tare_value=0)  # Default value
 
     # Define command-line arguments with defaults from the configuration file
     parser = argparse.ArgumentParser(description="Scale Operation")
-    parser.add_argument("-t", "--tare", nargs='?', type=float, const=safe_getfloat(config, 'DEFAULT', 'tare_weight', 0.0), default=np.inf, help="Tare the scale to the specified weight. If no weight is provided, default to 0.0")
+    parser.add_argument("-t", "--tare", nargs='?', type=float, const=settings.getfloat('tare_weight', 0.0), default=np.inf, help="Tare the scale to the specified weight. If no weight is provided, default to 0.0")
     parser.add_argument("-c", "--calibrate", type=float, help="Calibrate the scale with a known weight")
-    parser.add_argument("-d", "--duration", type=float, default=safe_getfloat(config, 'DEFAULT', 'duration', 1.0), help="Sample duration in seconds")
-    parser.add_argument("-n", "--number", type=int, default=config.getint('DEFAULT', 'number', fallback=1), help="Number of samples of given duration to report")
-    parser.add_argument("-o", "--output", type=str, default=config.get('DEFAULT', 'output', fallback='samples.txt'), help="Path to output results")
-    parser.add_argument("-p", "--plot", type=str, default=config.get('DEFAULT', 'plot', fallback='samples.png'), help="Path to output chart of results")
-    parser.add_argument("-H", "--host", type=str, default=config.get('DEFAULT', 'host', fallback='localhost'), help="Host address for the HTTP server")
-    parser.add_argument("-P", "--port", type=int, default=config.getint('DEFAULT', 'port', fallback=0), help="Port for the HTTP server")
-    parser.add_argument("--density", type=float, default=safe_getfloat(config, 'DEFAULT', 'density_gcm3', 1.07), help="The material density in g/cm^3, used to estimate remaining material length")
-    parser.add_argument("--diameter", type=float, default=safe_getfloat(config, 'DEFAULT', 'diameter_mm', 1.75), help="The material diameter in mm, used to estimate remaining material length")
+    parser.add_argument("-d", "--duration", type=float, default=settings.getfloat('duration', 1.0), help="Sample duration in seconds")
+    parser.add_argument("-n", "--number", type=int, default=settings.getint('number', 1), help="Number of samples of given duration to report")
+    parser.add_argument("-o", "--output", type=str, default=settings.get('output', 'samples.txt'), help="Path to legacy text results, imported into the store once")
+    parser.add_argument("-s", "--store", type=str, default=settings.get('store', 'samples.bin'), help="Path to the binary sample store")
+    parser.add_argument("-f", "--flush-interval", type=float, default=settings.getfloat('flush_interval', 60.0), help="Seconds between writes of new samples to the store")
+    parser.add_argument("-p", "--plot", type=str, default=settings.get('plot', 'samples.png'), help="Path to output chart of results")
+    parser.add_argument("-r", "--render-interval", type=float, default=settings.getfloat('render_interval', 5.0), help="Minimum seconds between chart renders")
+    parser.add_argument("-H", "--host", type=str, default=settings.get('host', 'localhost'), help="Host address for the HTTP server")
+    parser.add_argument("-P", "--port", type=int, default=settings.getint('port', 0), help="Port for the HTTP server")
+    parser.add_argument("-b", "--backend", type=str, default=settings.get('backend', 'hx711'), choices=SENSOR_BACKENDS, help="Sensor backend, 'fake' simulates the HX711s without GPIO, 'replay' plays back a recording")
+    parser.add_argument("--replay", type=str, default=settings.get('replay_file', 'samples.txt'), help="Recording played back by the replay backend, raw .npy capture or samples.txt")
+    parser.add_argument("--ci-method", type=str, default=settings.get('ci_method', 'order'), choices=CI_METHODS, help="Median confidence interval estimator")
+    parser.add_argument("--density", type=float, default=settings.getfloat('density_gcm3', 1.07), help="The material density in g/cm^3, used to estimate remaining material length")
+    parser.add_argument("--diameter", type=float, default=settings.getfloat('diameter_mm', 1.75), help="The material diameter in mm, used to estimate remaining material length")
 
     args = parser.parse_args()
 
@@ -64,84 +71,135 @@ def load_config_and_parse_args():
         'tare': 'tare_weight',
         'calibrate': 'target_weight',
         'density': 'density_gcm3',
-        'diameter': 'diameter_mm'
+        'diameter': 'diameter_mm',
+        'replay': 'replay_file'
     }
 
-    # Update the config file if any argument is provided
+    # Collect the provided arguments under their config names
     args_dict = vars(args)
-    for cli_arg, config_name in cli_to_config_map.items():
-        if args_dict.get(cli_arg) is not None:
-            config['DEFAULT'][config_name] = str(args_dict[cli_arg])
+    values = {}
+    for arg, value in args_dict.items():
+        if value is not None:
+            values[cli_to_config_map.get(arg, arg)] = value
 
-    # Directly map arguments without name changes
-    for arg in args_dict:
-        if arg not in cli_to_config_map and args_dict[arg] is not None:
-            config['DEFAULT'][arg] = str(args_dict[arg])
+    # Save updates to the config file, which only happens if something changed
+    settings.update(**values)
 
-    # Save updates to config file
-    with open(config_file, 'w') as configfile:
-        config.write(configfile)
+    return args, settings
 
-    return args, config
+def scale_path(settings, option, name, fallback):
+    # Scales share [DEFAULT], so file names they inherit from it get the scale name added
+    path = settings.get(option, fallback)
+    if name and path and settings.is_default(option):
+        root, ext = os.path.splitext(path)
+        path = f"{root}_{name}{ext}"
+    return path
 
-def state_machine(state_queue, args, config_file):
-    scale = Scale()
+def state_machine(scale, commands, settings, renderer, stop_event=None):
     
     try:
-        while True:
-            config = configparser.ConfigParser()
-            config.read(config_file)  # Reload the configuration on each iteration
-            duration = safe_getfloat(config, 'DEFAULT', 'duration', 1.0)
-            tare_weight = safe_getfloat(config, 'DEFAULT', 'tare_weight', 0.0)
-            tare_value = safe_getfloat(config, 'DEFAULT', 'tare_value', 0.0)
-            target_weight = safe_getfloat(config, 'DEFAULT', 'target_weight', 1000.0)
-            scale_factor = safe_getfloat(config, 'DEFAULT', 'scale_factor', 1.0)
-            buffer_length = int(config['DEFAULT']['number'])
-            sample_file = config['DEFAULT']['output']
-            plot_file = config['DEFAULT']['plot']
-            density_gcm3 = safe_getfloat(config, 'DEFAULT', 'density_gcm3', 1.07)
-            diameter = safe_getfloat(config, 'DEFAULT', 'diameter_mm', 1.75)            
+        while stop_event is None or not stop_event.is_set():
+            # Values come from the in-memory config, which the HTTP server updates in place
+            duration = settings.getfloat('duration', 1.0)
+            tare_value = settings.getfloat('tare_value', 0.0)
+            corner_tare = settings.getfloats('corner_tare')
+            corner_scale = settings.getfloats('corner_scale')
+            target_weight = settings.getfloat('target_weight', 1000.0)
+            scale_factor = settings.getfloat('scale_factor', 1.0)
+            buffer_length = settings.getint('number', 1)
+            sample_file = scale_path(settings, 'store', scale.name, 'samples.bin')
+            legacy_file = scale_path(settings, 'output', scale.name, None)
+            plot_file = scale_path(settings, 'plot', scale.name, None)
+            flush_interval = settings.getfloat('flush_interval', 60.0)
+            smoothing = settings.get('smoothing', 'incremental')
+            max_window = settings.getint('max_window', 301)
+            density_gcm3 = settings.getfloat('density_gcm3', 1.07)
+            diameter = settings.getfloat('diameter_mm', 1.75)
+            empty_weight = settings.getfloat('empty_weight', 0.0)
+            adaptive = settings.getboolean('adaptive', False)
+            min_duration = settings.getfloat('min_duration', 1.0)
+            precision_target = settings.getfloat('precision_target', 0.0)
+            per_corner = settings.getboolean('per_corner_calibration', True)
+            auto_zero_band = settings.getfloat('auto_zero_band', 0.0)
+            auto_zero_threshold = settings.getfloat('auto_zero_threshold', 0.2)
+            auto_zero_minutes = settings.getfloat('auto_zero_minutes', 10.0)
             
-            try:
-                state = state_queue.get_nowait()
-            except queue.Empty:
-                state = STATE_MEASURING  # Default state if the queue is empty
+            state, params = commands.get()
 
             if state == STATE_MEASURING:               
-                time_array, sample_buffer, smoothed_data = scale.measure(
-                    duration, 
-                    scale_factor, 
-                    tare_value, 
-                    sample_file, 
-                    buffer_length)
+                with instrumentation.stage('measure', scale.name):
+                    result = scale.measure(
+                        duration, 
+                        scale_factor, 
+                        tare_value, 
+                        sample_file, 
+                        buffer_length,
+                        legacy_file=legacy_file,
+                        flush_interval=flush_interval,
+                        smoothing=smoothing,
+                        max_window=max_window,
+                        interrupt=commands.interrupt,
+                        corner_tare=corner_tare,
+                        corner_scale=corner_scale,
+                        density_gcm3=density_gcm3,
+                        diameter_mm=diameter,
+                        empty_weight=empty_weight,
+                        precision_target=precision_target,
+                        min_duration=min_duration,
+                        adaptive=adaptive,
+                        auto_zero_band=auto_zero_band,
+                        auto_zero_threshold=auto_zero_threshold,
+                        auto_zero_minutes=auto_zero_minutes)
+                if scale.auto_tare is not None:
+                    # Zero drift followed while the scale was empty, saved without stopping measurement
+                    tare_value, corner_tare = scale.auto_tare
+                    scale.auto_tare = None
+                    settings.update(tare_value=tare_value, corner_tare=corner_tare)
+                    print(f"Zero tracking re-tared to {tare_value:.1f}")
+                if result is None:
+                    # Interrupted by a command, or no samples
+                    continue
+                time_array, sample_buffer, smoothed_data = result
+                # Only the first is reported
+                startup.mark('first_sample', scale.name)
                     
-                scale.plot(time_array, sample_buffer, smoothed_data, plot_file)
-                
-                time_to_zero_timedelta, estimated_zero_datetime = scale.estime_time_to_zero( duration, smoothed_data)        
+                with instrumentation.stage('render', scale.name):
+                    renderer.submit(time_array, sample_buffer, smoothed_data, plot_file, density_gcm3, diameter)
+
+                instrumentation.end_cycle(scale.last_sample_count, scale.samples_per_second, scale.name)
                                                            
             elif state == STATE_TARING:
                 print("Taring...")
-                tare_value = scale.tare(duration)
+                with instrumentation.stage('tare', scale.name):
+                    tare_value, corner_tare = scale.tare(duration)
                 
-                config['DEFAULT']['tare_value'] = str(tare_value)
-                with open(config_file, 'w') as configfile:
-                    config.write(configfile)
+                settings.update(tare_value=tare_value, corner_tare=corner_tare)
                 print("Taring complete.")                
                 
             elif state == STATE_CALIBRATING:
+                target_weight = params.get('weight', target_weight)
                 print(f"Calibrating to {target_weight}")
                 
-                config['DEFAULT']['scale_factor'] = scale.calibrate(target_weight, duration)
-                with open(config_file, 'w') as configfile:
-                    config.write(configfile)
+                with instrumentation.stage('calibrate', scale.name):
+                    fit = scale.calibrate(target_weight, duration, tare_value, corner_tare, per_corner)
+                if fit is None:
+                    print("Calibration needs a weight other than the tare.")
+                    continue
+                settings.update(
+                    scale_factor=fit['scale_factor'],
+                    tare_value=fit['tare_value'],
+                    corner_tare=fit['corner_tare'],
+                    corner_scale=fit['corner_scale'],
+                    calibration_weights=fit['weights'],
+                    calibration_residuals=fit['residuals'],
+                    target_weight=target_weight)
 
-                print("Calibration complete.")
+                print(f"Calibration complete: {len(fit['weights'])} points, RMS residual {fit['rms']:.3f}")
                 
             elif state == STATE_CLEARING:
                 print("Clearing...")
-                sample_file = config['DEFAULT']['output']
-                if os.path.exists(sample_file):
-                    os.remove(sample_file)
+                with instrumentation.stage('clear', scale.name):
+                    scale.clear_samples(sample_file)
                 print("Clearing complete")
 
     except Exception as e:
@@ -152,29 +210,149 @@ def state_machine(state_queue, args, config_file):
         scale.cleanup()
    
 def signal_handler(sig, frame):
+    # The HTTP server runs on daemon threads, exiting main stops the state machines, which clean up their scales
     print('Shutting down the server...')
-    httpd.shutdown()  # Shutdown the server
-    httpd.server_close()  # Close the server socket
     sys.exit(0)
 
+def scale_sections(settings):
+    """Each scale's name and settings: its [scale:<name>] section, or [DEFAULT] for a single unnamed scale."""
+    return [(name, settings.view(f"scale:{name}") if name else settings) for name in settings.scale_names() or [None]]
+
+def sensor_config(args, section):
+    """A scale's sensor backend, pins and backend options."""
+    backend = section.get('backend', args.backend)
+    sensor_options = {}
+    if backend == 'replay':
+        sensor_options = {
+            'capture': section.get('replay_file', args.replay),
+            'sample_rate': section.getfloat('replay_rate', 80.0),
+            'tare_value': section.getfloat('tare_value', 0.0),
+            'scale_factor': section.getfloat('scale_factor', 1.0),
+        }
+    return backend, parse_pins(section.get('pins')) or DEFAULT_PINS, sensor_options
+
+def create_handles(args, settings):
+    """One ScaleHandle per scale, its Scale left None until `start_scale` has reset the sensors."""
+    handles = []
+    for name, section in scale_sections(settings):
+        # Render each chart on its own thread, so acquisition never waits for matplotlib
+        renderer = ChartRenderer(
+            section.getfloat('render_interval', args.render_interval),
+            section.getint('plot_points', 2000),
+            section.get('decimation', 'minmax'))
+        renderer.start()
+        handles.append(ScaleHandle(name, None, CommandQueue(), section, renderer))
+    return handles
+
+def create_scale(args, name, section, scheduler, rings=None):
+    """A scale's Scale, reading its frames from the shared memory ring named in `rings` if given."""
+    backend, pins, sensor_options = sensor_config(args, section)
+    frame_source = SharedFrames(FrameRing(rings[name]), name) if rings else None
+    return Scale(
+        backend=backend,
+        ci_method=section.get('ci_method', args.ci_method),
+        pins=pins,
+        scheduler=scheduler,
+        name=name,
+        rollup_tiers=parse_tiers(section.get('rollup_tiers')),
+        rollup_capacity=section.getint('rollup_capacity', 50000),
+        sensor_options=sensor_options,
+        forecast_minutes=section.getfloat('forecast_minutes', 10.0),
+        frame_source=frame_source,
+        reject_sigma=section.getfloat('reject_sigma', 6.0),
+        reject_window=section.getint('reject_window', 15))
+
+def start_scale(args, handle, scheduler, rings, stop_event):
+    """Reset a scale's sensors, then measure it until stopped.
+
+    Each scale runs this on its own thread, so every scale is reset at once while
+    the HTTP server already reports it as initialising.
+    """
+    try:
+        handle.scale = create_scale(args, handle.name, handle.settings, scheduler, rings)
+    except Exception as e:
+        print(f"Scale {scale_label(handle.name)} failed to start: {e}")
+        traceback.print_exc()
+        return
+    startup.mark('sensors', handle.name)
+    state_machine(handle.scale, handle.commands, handle.settings, handle.renderer, stop_event)
+
+def run(args, settings, rings=None):
+    """Measure, serve and render every scale until the process is stopped.
+
+    With `rings`, a dict of shared memory ring names by scale name, frames come from a
+    separate acquisition process rather than sensors read here.
+    """
+    host = args.host
+    port = args.port
+    cur_dir = os.path.dirname(os.path.abspath(__file__))
+
+    instrumentation.configure(
+        settings.getboolean('instrumentation', True),
+        settings.get('metrics_csv', '') or None,
+        settings.getint('metrics_csv_max_bytes', 1024 * 1024))
+
+    # All the scales' load cells are read by one pool of threads
+    scheduler = None
+    if rings is None:
+        scheduler = AcquisitionScheduler(settings.getint('acquisition_workers', 4), data_rate=settings.getfloat('hx711_rate', 80.0))
+    handles = create_handles(args, settings)
+
+    # Serve straight away, with each scale initialising until its sensors are reset
+    max_connections = settings.getint('max_connections', 32)
+    max_streams = settings.getint('max_streams', 8)
+    http_server_thread = threading.Thread(target=start_http_server, args=(host, port, cur_dir, handles, max_connections, max_streams))
+    http_server_thread.daemon = True
+    http_server_thread.start()
+
+    # One thread per scale, resetting its sensors alongside the others' and then running its
+    # state machine, which cleans up the scale when stopped
+    stop_event = threading.Event()
+    threads = []
+    for handle in handles:
+        thread = threading.Thread(target=start_scale, args=(args, handle, scheduler, rings, stop_event),
+                                  name=f"state-machine-{scale_label(handle.name)}")
+        thread.start()
+        threads.append(thread)
+
+    # Import the filtering and plotting modules while the first window is measured
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+    try:
+        # Wait on the event rather than joining: a join interrupted by the signal handler's
+        # SystemExit can leave a running thread marked as stopped, skipping its cleanup
+        while any(thread.is_alive() for thread in threads):
+            stop_event.wait(0.5)
+    finally:
+        stop_event.set()
+        for handle in handles:
+            handle.commands.interrupt.set()
+        for thread in threads:
+            thread.join()
+        if scheduler is not None:
+            scheduler.stop()
+            for backend in set(handle.scale.backend for handle in handles if handle.scale is not None):
+                release_gpio(backend)
+
 def main():  
+    if sys.argv[1:2] == ['reprocess']:
+        # Batch reprocessing of a recorded history, rather than measuring
+        from reprocess import main as reprocess_main
+        return reprocess_main(sys.argv[2:])
+
     signal.signal(signal.SIGINT, signal_handler)  # Catch CTRL+C and shutdown gracefully
     signal.signal(signal.SIGTERM, signal_handler)  # Catch CTRL+C and shutdown gracefully
+    startup.mark('imports')
         
-    args, config = load_config_and_parse_args()
-    
-    # Pass the scale, current_state, and state_lock to the server
-    host = config['DEFAULT']['host']
-    port = int(config['DEFAULT']['port'])
-    cur_dir = os.path.dirname(os.path.abspath(__file__))
-    
-    state_queue = queue.Queue(maxsize=1)
-    
-    http_server_thread = threading.Thread(target=start_http_server, args=(host, port, cur_dir, state_queue))
-    http_server_thread.daemon = True
-    http_server_thread.start()
-    
-    state_machine(state_queue, args, 'scale_config.ini')
+    args, settings = load_config_and_parse_args()
+    startup.mark('config')
+
+    if settings.getboolean('processes', False):
+        # Acquisition and the rest in separate, supervised processes
+        from supervisor import supervise
+        supervise(args, settings)
+    else:
+        run(args, settings)
         
 if __name__ == "__main__":
     main()
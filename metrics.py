@@ -0,0 +1,285 @@
+import bisect
+import csv
+import os
+import threading
+import time
+
+# Latency buckets in seconds, from 1 ms to 10 s
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+def label_pairs(label_name, label):
+    # A tuple of label names takes a tuple of values, one per name
+    if not label_name:
+        return []
+    if isinstance(label_name, tuple):
+        return list(zip(label_name, label))
+    return [(label_name, label)]
+
+def scale_label(name):
+    """The `scale` label value of a scale, 'default' for the single unnamed one."""
+    return name or 'default'
+
+class Histogram:
+    """Cumulative histogram in the Prometheus text format, with one series per label value."""
+
+    def __init__(self, name, help_text, label_name=None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_name = label_name
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, label=None):
+        with self._lock:
+            series = self._series.get(label)
+            if series is None:
+                # Per-bucket counts, then the count and sum
+                series = self._series[label] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def totals(self):
+        """The count and sum of the observations of each label."""
+        with self._lock:
+            return {label: (sum(values[:-1]), values[-1]) for label, values in self._series.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {label: list(values) for label, values in self._series.items()}
+        for label, values in sorted(series.items(), key=lambda item: str(item[0])):
+            base = label_pairs(self.label_name, label)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values[:-1]):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{self.name}_bucket{format_labels(base + [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(base)} {values[-1]}")
+            lines.append(f"{self.name}_count{format_labels(base)} {cumulative}")
+        return '\n'.join(lines)
+
+class Counter:
+    """Monotonic counter, or a gauge when `kind` is 'gauge', with one series per label value."""
+
+    def __init__(self, name, help_text, label_name=None, kind='counter'):
+        self.name = name
+        self.help_text = help_text
+        self.label_name = label_name
+        self.kind = kind
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, label=None):
+        with self._lock:
+            self._values[label] = self._values.get(label, 0) + amount
+
+    def set(self, value, label=None):
+        self._values[label] = value
+
+    def get(self, label=None):
+        return self._values.get(label, 0)
+
+    def total(self, first=None):
+        """Sum of every series, or of those whose first label value is `first`."""
+        if first is None:
+            return sum(self._values.values())
+        return sum(value for label, value in self._values.items() if label[0] == first)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for label, value in sorted(self._values.items(), key=lambda item: str(item[0])):
+            labels = label_pairs(self.label_name, label)
+            lines.append(f"{self.name}{format_labels(labels)} {value}")
+        return '\n'.join(lines)
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+registry = MetricsRegistry()
+
+class StageTimer:
+    __slots__ = ('instrumentation', 'stage', 'scale', 'start')
+
+    def __init__(self, instrumentation, stage, scale):
+        self.instrumentation = instrumentation
+        self.stage = stage
+        self.scale = scale
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.record_stage(self.stage, time.perf_counter() - self.start, self.scale)
+        return False
+
+class NullTimer:
+    """Shared do-nothing timer returned while instrumentation is disabled."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_TIMER = NullTimer()
+
+class CsvRecorder:
+    """Appends one row per cycle to a CSV file, rolling it over to `path`.1 at `max_bytes`."""
+
+    def __init__(self, path, fieldnames, max_bytes=1024 * 1024):
+        self.path = path
+        self.fieldnames = ['timestamp'] + list(fieldnames)
+        self.max_bytes = max_bytes
+        # Scales end their cycles on their own threads
+        self._lock = threading.Lock()
+
+    def write(self, row):
+        with self._lock:
+            self._write(row)
+
+    def _write(self, row):
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+            os.replace(self.path, self.path + ".1")
+        new_file = not os.path.exists(self.path)
+        with open(self.path, 'a', newline='') as f:
+            writer = csv.DictWriter(f, self.fieldnames, extrasaction='ignore')
+            if new_file:
+                writer.writeheader()
+            writer.writerow(dict(row, timestamp=f"{time.time():.3f}"))
+
+class Instrumentation:
+    """Per-stage timers and acquisition counters for the measuring loop.
+
+    Every series carries a `scale` label, and each scale's cycle is collected separately,
+    so scales measuring concurrently neither overwrite nor mix each other's values. While
+    disabled, `stage()` returns a shared no-op timer and the acquisition threads skip their
+    per-read timing, so the cost is a flag check.
+    """
+
+    STAGES = ('collect', 'reject', 'convert', 'corners', 'ci', 'store', 'forecast', 'smooth', 'publish', 'measure', 'render', 'tare', 'calibrate', 'clear')
+    WINDOW_FIELDS = ('window_seconds', 'window_ci', 'cpu_seconds', 'precision_per_cpu_second')
+    CYCLE_FIELDS = ('scale', 'samples', 'samples_per_second', 'invalid_reads', 'rejected_reads', 'dropped_frames') + WINDOW_FIELDS + STAGES
+
+    def __init__(self, registry):
+        self.enabled = True
+        self.csv = None
+        # The cycle being collected by each scale, by `scale` label
+        self._cycles = {}
+        self.stage_seconds = registry.register(Histogram(
+            'hx4_stage_duration_seconds', 'Time spent in each stage of the measuring loop', ('scale', 'stage')))
+        self.sensor_read_seconds = registry.register(Histogram(
+            'hx4_sensor_read_duration_seconds', 'HX711 read latency per sensor', ('scale', 'sensor'),
+            buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5)))
+        self.invalid_reads = registry.register(Counter(
+            'hx4_invalid_reads_total', 'HX711 reads that failed or returned no data', ('scale', 'sensor')))
+        self.rejected_reads = registry.register(Counter(
+            'hx4_rejected_reads_total', 'HX711 reads dropped as glitches by the Hampel filter', ('scale', 'sensor')))
+        self.dropped_frames = registry.register(Counter(
+            'hx4_dropped_frames_total', 'Frames dropped because the consumer fell behind', 'scale'))
+        self.cycles = registry.register(Counter(
+            'hx4_cycles_total', 'Completed measurement cycles', 'scale'))
+        self.samples_per_cycle = registry.register(Counter(
+            'hx4_samples_per_cycle', 'Frames collected in the last measurement window', 'scale', kind='gauge'))
+        self.samples_per_second = registry.register(Counter(
+            'hx4_samples_per_second', 'Achieved acquisition rate', 'scale', kind='gauge'))
+        self.window_seconds = registry.register(Counter(
+            'hx4_window_seconds', 'Length of the last measurement window', 'scale', kind='gauge'))
+        self.window_ci = registry.register(Counter(
+            'hx4_window_ci', 'Confidence interval width of the last window\'s median', 'scale', kind='gauge'))
+        self.window_cpu_seconds = registry.register(Counter(
+            'hx4_window_cpu_seconds', 'CPU time of the measuring thread over the last window', 'scale', kind='gauge'))
+        self.precision_per_cpu_second = registry.register(Counter(
+            'hx4_precision_per_cpu_second', 'Precision (1 / CI width squared) of the last window per CPU second', 'scale', kind='gauge'))
+
+    def configure(self, enabled=True, csv_file=None, csv_max_bytes=1024 * 1024):
+        self.enabled = enabled
+        self.csv = CsvRecorder(csv_file, self.CYCLE_FIELDS, csv_max_bytes) if enabled and csv_file else None
+
+    def _cycle(self, scale):
+        # Only the scale's own thread touches its cycle
+        return self._cycles.setdefault(scale, {})
+
+    def stage(self, name, scale=None):
+        if not self.enabled:
+            return NULL_TIMER
+        return StageTimer(self, name, scale_label(scale))
+
+    def record_stage(self, name, seconds, scale='default'):
+        self.stage_seconds.observe(seconds, (scale, name))
+        self._cycle(scale)[name] = f"{seconds:.6f}"
+
+    def record_read(self, label, seconds):
+        """A read's latency, labelled by the (scale, sensor) pair."""
+        self.sensor_read_seconds.observe(seconds, label)
+
+    def record_window(self, seconds, ci, cpu_seconds, scale=None):
+        """Precision bought per CPU second, 1 / (ci^2 * cpu_seconds), for tuning the window settings."""
+        if not self.enabled:
+            return
+        scale = scale_label(scale)
+        cycle = self._cycle(scale)
+        self.window_seconds.set(round(seconds, 3), scale)
+        self.window_ci.set(ci, scale)
+        self.window_cpu_seconds.set(round(cpu_seconds, 4), scale)
+        cycle.update(window_seconds=f"{seconds:.3f}", window_ci=ci, cpu_seconds=f"{cpu_seconds:.4f}")
+        if ci > 0 and cpu_seconds > 0:
+            precision = 1.0 / (ci * ci * cpu_seconds)
+            self.precision_per_cpu_second.set(round(precision, 3), scale)
+            cycle['precision_per_cpu_second'] = f"{precision:.3f}"
+
+    def end_cycle(self, samples, samples_per_second, scale=None):
+        if not self.enabled:
+            return
+        scale = scale_label(scale)
+        cycle = self._cycles.pop(scale, {})
+        self.cycles.inc(label=scale)
+        self.samples_per_cycle.set(samples, scale)
+        self.samples_per_second.set(round(samples_per_second, 2), scale)
+        if self.csv is not None:
+            row = dict(cycle, scale=scale, samples=samples, samples_per_second=f"{samples_per_second:.2f}",
+                       invalid_reads=self.invalid_reads.total(scale),
+                       rejected_reads=self.rejected_reads.total(scale),
+                       dropped_frames=self.dropped_frames.get(scale))
+            try:
+                self.csv.write(row)
+            except OSError as e:
+                print("Failed to write metrics CSV", e)
+
+instrumentation = Instrumentation(registry)
+
+class StartupReport:
+    """Seconds from process start to each startup milestone, printed and exported as a gauge.
+
+    The clock starts when this module is first imported, so import it before anything heavy.
+    """
+
+    def __init__(self, registry):
+        self.start = time.monotonic()
+        self.seconds = registry.register(Counter(
+            'hx4_startup_seconds', 'Seconds from process start to each startup milestone', 'phase', kind='gauge'))
+
+    def mark(self, phase, name=None):
+        label = f"{phase}:{name}" if name else phase
+        if self.seconds.get(label):
+            return
+        elapsed = time.monotonic() - self.start
+        self.seconds.set(round(elapsed, 3), label)
+        print(f"Startup: {label} after {elapsed:.3f} s", flush=True)
+
+startup = StartupReport(registry)
@@ -0,0 +1,193 @@
+import os
+import threading
+import time
+import traceback
+
+import numpy as np
+
+from forecast import metres_per_gram
+
+DECIMATION_METHODS = ('minmax', 'lttb')
+
+def minmax_indices(y, max_points):
+    """Indices of the minimum and maximum of `y` in each of max_points/2 equal buckets.
+
+    Keeps every peak and trough visible while bounding the number of points drawn.
+    """
+    n = len(y)
+    if n <= max_points:
+        return np.arange(n)
+    buckets = max(1, max_points // 2)
+    bucket_size = int(np.ceil(n / buckets))
+    padded = np.pad(y, (0, buckets * bucket_size - n), mode='edge').reshape(buckets, bucket_size)
+    offsets = np.arange(buckets) * bucket_size
+    indices = np.concatenate([offsets + padded.argmin(axis=1), offsets + padded.argmax(axis=1)])
+    return np.unique(np.minimum(indices, n - 1))
+
+def lttb_indices(x, y, max_points):
+    """Largest-Triangle-Three-Buckets downsampling, preserving the visual shape of the line."""
+    n = len(y)
+    if n <= max_points or max_points < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, max_points - 1).astype(int)
+    indices = np.empty(max_points, dtype=int)
+    indices[0] = 0
+    indices[-1] = n - 1
+    previous = 0
+    for i in range(max_points - 2):
+        start, end = edges[i], edges[i + 1]
+        # Average of the next bucket is the third corner of the triangle
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        next_x = x[end:next_end].mean()
+        next_y = y[end:next_end].mean()
+        area = np.abs((x[previous] - next_x) * (y[start:end] - y[previous])
+                      - (x[previous] - x[start:end]) * (next_y - y[previous]))
+        previous = start + int(area.argmax())
+        indices[i + 1] = previous
+    return indices
+
+def decimate_indices(x, y, max_points, method='minmax'):
+    if method == 'lttb':
+        return lttb_indices(x, y, max_points)
+    return minmax_indices(y, max_points)
+
+class ChartRenderer:
+    """Renders the weight chart on a worker thread, off the measuring loop.
+
+    One Agg figure is kept for the life of the renderer and its artists are updated in place.
+    The history is decimated to about `max_points` points, rendering happens at most once per
+    `render_interval` seconds, and is skipped while nobody has requested the chart since the
+    last render.
+    """
+
+    def __init__(self, render_interval=5.0, max_points=2000, decimation='minmax'):
+        self.render_interval = render_interval
+        self.max_points = max_points
+        self.decimation = decimation
+        self.render_count = 0
+        self.skipped_count = 0
+
+        self._lock = threading.Lock()
+        self._pending = None
+        self._data_event = threading.Event()
+        self._requested = threading.Event()
+        self._requested.set()
+        self._stop_event = threading.Event()
+        self._figure = None
+        self._last_render = 0.0
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="chart-renderer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._data_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def submit(self, time_array, sample_buffer, smoothed_data, plot_file="samples.png", density_gcm3=1.07, diameter_mm=1.75):
+        """Hand the latest history to the renderer, replacing any not yet rendered."""
+        if plot_file is None or sample_buffer is None or smoothed_data is None:
+            return
+        if len(sample_buffer) <= 1 or len(smoothed_data) != len(sample_buffer):
+            return
+        # Copy, as the arrays are views of ring buffers that the measuring loop keeps writing
+        data = (np.array(time_array), np.array(sample_buffer), np.array(smoothed_data), plot_file, density_gcm3, diameter_mm)
+        with self._lock:
+            self._pending = data
+        self._data_event.set()
+
+    def mark_requested(self):
+        """Called when a client fetches the chart."""
+        self._requested.set()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._data_event.wait()
+            if self._stop_event.is_set():
+                break
+
+            delay = self._last_render + self.render_interval - time.monotonic()
+            if delay > 0:
+                self._stop_event.wait(delay)
+                continue
+
+            with self._lock:
+                data = self._pending
+                if data is None:
+                    self._data_event.clear()
+                    continue
+                waiting = not self._requested.is_set() and os.path.exists(data[3])
+                if not waiting:
+                    self._pending = None
+                    self._data_event.clear()
+                    self._requested.clear()
+
+            if waiting:
+                # Keep the data pending until someone asks for the chart
+                self.skipped_count += 1
+                self._requested.wait(self.render_interval)
+                continue
+
+            try:
+                self.render(*data)
+            except Exception as e:
+                print("Exception in ChartRenderer.render", e)
+                traceback.print_exc()
+            self._last_render = time.monotonic()
+
+    def _create_figure(self):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.ticker import MaxNLocator
+
+        figure = Figure(figsize=(10, 6))
+        FigureCanvasAgg(figure)
+        ax = figure.add_subplot()
+        self._scatter = ax.scatter([], [], label='Raw Weight (g)', alpha=0.9, s=10, color='gray')
+        self._line, = ax.plot([], [], label='Smoothed Weight (g)', color='blue')
+        ax.set_xlabel('Time (min)')
+        ax.set_ylabel('Weight (g)')
+        ax.set_title('Weight Measurement Over Time')
+        ax.yaxis.set_major_locator(MaxNLocator(integer=True, nbins=10))
+
+        # Secondary y-axis (length)
+        ax2 = ax.twinx()
+        self._length_line, = ax2.plot([], [], label='Filament Length (m)', color='blue')
+        ax2.set_ylabel('Length (m)')
+        ax2.yaxis.set_major_locator(MaxNLocator(nbins=10))
+
+        self._ax = ax
+        self._ax2 = ax2
+        self._figure = figure
+
+    def render(self, time_array, sample_buffer, smoothed_data, plot_file, density_gcm3=1.07, diameter_mm=1.75):
+        if self._figure is None:
+            self._create_figure()
+
+        # Weight to length conversion (m per g)
+        length_per_g = metres_per_gram(density_gcm3, diameter_mm)
+
+        raw_indices = decimate_indices(time_array, sample_buffer, self.max_points, self.decimation)
+        smoothed_indices = decimate_indices(time_array, smoothed_data, self.max_points, self.decimation)
+        smoothed_time = time_array[smoothed_indices]
+        smoothed = smoothed_data[smoothed_indices]
+
+        self._scatter.set_offsets(np.column_stack([time_array[raw_indices], sample_buffer[raw_indices]]))
+        self._line.set_data(smoothed_time, smoothed)
+        self._length_line.set_data(smoothed_time, smoothed * length_per_g)
+
+        # Axis limits follow the smoothed data with a 5% margin, as the raw data may hold outliers
+        low, high = smoothed.min(), smoothed.max()
+        margin = (high - low) * 0.05 or 1.0
+        self._ax.set_xlim(time_array[0], time_array[-1])
+        self._ax.set_ylim(low - margin, high + margin)
+        self._ax2.set_ylim((low - margin) * length_per_g, (high + margin) * length_per_g)
+
+        tmp_file = plot_file + ".tmp.png"
+        self._figure.savefig(tmp_file)
+        os.replace(tmp_file, plot_file)
+        self.render_count += 1
@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from config_service import ConfigService
+from sample_store import SampleStore, CORNERS, read_store, read_text
+from smoothing import filter_data, smooth_series, effective_window
+from rollup import Rollup, parse_tiers
+from forecast import SpoolForecaster
+
+def convert(records, scale_factor, tare_value, from_scale_factor, from_tare_value):
+    """Records converted to a new scale factor and tare from those they were measured with.
+
+    Stored weights are linear in the raw total, so they map exactly; the CI scales with the
+    factor, and the tare change is shared evenly between the corners.
+    """
+    ratio = scale_factor / from_scale_factor
+    shift = (from_tare_value - tare_value) * scale_factor
+    converted = records.copy()
+    converted['median'] = records['median'] * ratio + shift
+    converted['ci'] = records['ci'] * abs(ratio)
+    converted['corners'] = records['corners'] * ratio + shift / CORNERS
+    return converted
+
+def filter_chunk(values, window, start, stop):
+    # filter_data over a chunk and its margins, keeping the chunk
+    return filter_data(values, window)[0][start:stop]
+
+def filter_history(values, window, chunk_size=262144, workers=None):
+    """filter_data over the whole history, in chunks spread over a process pool.
+
+    Each chunk is filtered with two windows of its neighbours either side, as far as the
+    three median filters and the Wiener filter reach. The outlier threshold and the Wiener
+    filter's noise estimate are both taken per chunk, so a chunk much noisier or steadier
+    than the rest is smoothed differently from filtering the history in one go.
+    """
+    window = window + 1 if window % 2 == 0 else window
+    margin = 2 * window
+    jobs = []
+    for begin in range(0, len(values), chunk_size):
+        end = min(begin + chunk_size, len(values))
+        low, high = max(0, begin - margin), min(len(values), end + margin)
+        jobs.append((values[low:high], window, begin - low, end - low))
+    if not jobs:
+        return np.array(values)
+    if workers == 1 or len(jobs) == 1:
+        parts = [filter_chunk(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            parts = list(executor.map(filter_chunk, *zip(*jobs)))
+    return np.concatenate(parts)
+
+def reprocess(records, args):
+    """Convert, smooth and forecast the history with new parameters, returning the records, smoothing and forecast."""
+    records = convert(records, args.scale_factor, args.tare_value, args.from_scale_factor, args.from_tare_value)
+    medians = records['median']
+
+    sample_duration = float(np.median(np.diff(records['timestamp']))) if len(records) > 1 else args.duration
+    window = max(1, int(args.low_pass_minutes * 60 / sample_duration))
+    if len(medians) < 2:
+        smoothed = np.array(medians)
+    elif args.smoothing == 'full':
+        smoothed = filter_history(medians, window, args.chunk_size, args.workers)
+    else:
+        # The recursive filters run over the whole series, and are fast enough to run in one process
+        smoothed = smooth_series(medians, effective_window(window, args.max_window))[0]
+
+    forecaster = SpoolForecaster(time_constant=args.forecast_minutes * 60)
+    forecaster.prime(records['timestamp'], medians)
+    forecast = forecaster.report(args.density, args.diameter, args.empty_weight)
+    return records, smoothed, forecast
+
+def write_results(records, smoothed, args):
+    store = SampleStore(args.output, max(len(records), 1))
+    store.extend(records)
+    store.flush()
+    store.close()
+    rollup = Rollup(args.output, parse_tiers(args.rollup_tiers))
+    rollup.prime(records)
+    rollup.close()
+    if args.plot and len(records) > 1:
+        from renderer import ChartRenderer
+        time_array = (records['timestamp'] - records['timestamp'][0]) / 60
+        ChartRenderer().render(time_array, records['median'], smoothed, args.plot, args.density, args.diameter)
+
+def main(argv=None):
+    settings = ConfigService('scale_config.ini')
+    scale_factor = settings.getfloat('scale_factor', 1.0)
+    tare_value = settings.getfloat('tare_value', 0.0)
+
+    parser = argparse.ArgumentParser(prog="hx4.py reprocess", description="Re-run conversion, smoothing and forecasting over a recorded history with new parameters")
+    parser.add_argument("input", type=str, help="Binary store, or samples.txt of medians, to reprocess")
+    parser.add_argument("-o", "--output", type=str, required=True, help="New binary store to write, with its rollup tiers")
+    parser.add_argument("-p", "--plot", type=str, default=None, help="Chart of the reprocessed history to write")
+    parser.add_argument("--scale-factor", type=float, default=scale_factor, help="New scale factor")
+    parser.add_argument("--tare-value", type=float, default=tare_value, help="New tare value")
+    parser.add_argument("--from-scale-factor", type=float, default=scale_factor, help="Scale factor the history was measured with")
+    parser.add_argument("--from-tare-value", type=float, default=tare_value, help="Tare value the history was measured with")
+    parser.add_argument("--low-pass-minutes", type=float, default=settings.getfloat('low_pass_minutes', 10.0), help="Smoothing window in minutes")
+    parser.add_argument("--smoothing", type=str, default=settings.get('smoothing', 'incremental'), choices=('incremental', 'full'), help="The live smoother, or filter_data in chunks across processes")
+    parser.add_argument("--max-window", type=int, default=settings.getint('max_window', 301), help="Largest window of the incremental smoother")
+    parser.add_argument("--density", type=float, default=settings.getfloat('density_gcm3', 1.07), help="The material density in g/cm^3")
+    parser.add_argument("--diameter", type=float, default=settings.getfloat('diameter_mm', 1.75), help="The material diameter in mm")
+    parser.add_argument("--empty-weight", type=float, default=settings.getfloat('empty_weight', 0.0), help="Weight of the empty spool")
+    parser.add_argument("--forecast-minutes", type=float, default=settings.getfloat('forecast_minutes', 10.0), help="Forecast time constant in minutes")
+    parser.add_argument("--rollup-tiers", type=str, default=settings.get('rollup_tiers', '60,900,3600'), help="Rollup tiers of the new store")
+    parser.add_argument("-d", "--duration", type=float, default=settings.getfloat('duration', 1.0), help="Sample duration, used to reconstruct the timestamps of a samples.txt")
+    parser.add_argument("--chunk-size", type=int, default=262144, help="Samples per chunk of the full smoothing")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Processes for --smoothing full, one per CPU by default; incremental runs in one process")
+    args = parser.parse_args(argv)
+
+    if os.path.abspath(args.output) == os.path.abspath(args.input):
+        parser.error("the output must be a new store, not the input")
+    if os.path.exists(args.output):
+        parser.error(f"{args.output} already exists")
+    if args.from_scale_factor == 0:
+        parser.error("the history's scale factor must not be 0")
+
+    start = time.perf_counter()
+    records = read_text(args.input, args.duration) if args.input.endswith('.txt') else read_store(args.input)
+    loaded = time.perf_counter()
+    records, smoothed, forecast = reprocess(records, args)
+    processed = time.perf_counter()
+    write_results(records, smoothed, args)
+    written = time.perf_counter()
+
+    print(f"Reprocessed {len(records)} samples into {args.output}: read {loaded - start:.2f} s, "
+          f"processed {processed - loaded:.2f} s, written {written - processed:.2f} s")
+    print(json.dumps(forecast))
+
+if __name__ == "__main__":
+    main()
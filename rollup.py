@@ -0,0 +1,228 @@
+#!/usr/bin/python3
+import argparse
+import os
+import time
+
+import numpy as np
+
+from sample_store import SampleStore, SampleBuffer, HEADER_DTYPE
+
+# Bucket lengths in seconds of the default tiers above the raw samples: 1 min, 15 min and 1 h
+DEFAULT_TIERS = (60, 900, 3600)
+
+ROLLUP_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('min', '<f8'),
+    ('max', '<f8'),
+    ('median', '<f8'),
+    ('count', '<u4'),
+])
+
+class RollupStore(SampleStore):
+    """Memory-mapped ring buffer of ROLLUP_DTYPE records, with the same layout as a SampleStore."""
+    magic = b'HX4R'
+    version = 1
+    record_dtype = ROLLUP_DTYPE
+    record_dtypes = {1: ROLLUP_DTYPE}
+
+    def empty_records(self, count):
+        return np.zeros(count, dtype=self.record_dtype)
+
+def tier_path(sample_file, seconds):
+    """samples.bin holds the raw samples, samples.60s.bin the 1 minute tier and so on."""
+    root, ext = os.path.splitext(sample_file)
+    return f"{root}.{seconds}s{ext}"
+
+def parse_tiers(text):
+    if not text:
+        return DEFAULT_TIERS
+    return tuple(sorted(int(seconds) for seconds in text.split(',')))
+
+def rollup_records(timestamps, values, seconds):
+    """Min, max, median and count of `values` in each `seconds` long bucket, vectorised."""
+    buckets = np.floor(timestamps / seconds) * seconds
+    order = np.lexsort((values, buckets))
+    buckets = buckets[order]
+    values = values[order]
+    starts, counts = np.unique(buckets, return_index=True, return_counts=True)[1:]
+    records = np.zeros(len(starts), dtype=ROLLUP_DTYPE)
+    records['timestamp'] = buckets[starts]
+    records['min'] = values[starts]
+    records['max'] = values[starts + counts - 1]
+    records['median'] = (values[starts + (counts - 1) // 2] + values[starts + counts // 2]) / 2
+    records['count'] = counts
+    return records
+
+class RollupTier:
+    """One resolution of the history: a summary record per `seconds` long bucket.
+
+    Samples of the bucket being filled are held until the bucket ends, so every record
+    has the exact median of its bucket.
+    """
+
+    def __init__(self, seconds, capacity=50000, path=None):
+        self.seconds = seconds
+        self.buffer = SampleBuffer(capacity, ROLLUP_DTYPE)
+        self.store = None
+        # Time of the tier's first sample, which its bucket-floored records do not keep
+        self.first = None
+        if path is not None:
+            self.store = RollupStore(path, capacity)
+            self.buffer.extend(self.store.records())
+            self.buffer.unflushed = 0
+        self._bucket = None
+        self._values = []
+
+    def next_bucket(self):
+        """Start of the first bucket not yet summarised."""
+        records = self.buffer.records()
+        return records['timestamp'][-1] + self.seconds if len(records) else -np.inf
+
+    def prime(self, timestamps, values):
+        """Summarise history newer than the tier's last record, keeping the last bucket open."""
+        keep = timestamps >= self.next_bucket()
+        timestamps, values = timestamps[keep], values[keep]
+        if len(timestamps) == 0:
+            return
+        if self.first is None and not len(self.buffer):
+            self.first = timestamps[0]
+        records = rollup_records(timestamps, values, self.seconds)
+        self.buffer.extend(records[:-1])
+        self._bucket = records['timestamp'][-1]
+        self._values = list(values[timestamps >= self._bucket])
+
+    def add(self, timestamp, value):
+        if self.first is None and not len(self.buffer) and self._bucket is None:
+            self.first = timestamp
+        bucket = np.floor(timestamp / self.seconds) * self.seconds
+        if bucket != self._bucket:
+            self._close()
+            self._bucket = bucket
+        self._values.append(value)
+
+    def _close(self):
+        if self._bucket is None or not self._values:
+            return
+        values = np.array(self._values)
+        self.buffer.append_record((self._bucket, values.min(), values.max(), np.median(values), len(values)))
+        self._values = []
+
+    def records(self, since=-np.inf):
+        """Chronological copy of the buckets ending after `since`, including the one still being filled."""
+        records = self.buffer.records()
+        records = records[np.searchsorted(records['timestamp'], since - self.seconds, side='right'):]
+        if not self._values:
+            return np.array(records)
+        values = np.array(self._values)
+        current = np.array([(self._bucket, values.min(), values.max(), np.median(values), len(values))], dtype=ROLLUP_DTYPE)
+        return np.concatenate([records, current])
+
+    def oldest(self):
+        """Time of the first sample in the tier.
+
+        Only the first bucket is known of a tier loaded from disk, and its end stands in, so the
+        raw samples are preferred when they reach back into that bucket.
+        """
+        if self.first is not None:
+            return self.first
+        records = self.buffer.records()
+        if len(records):
+            return records['timestamp'][0] + self.seconds
+        return np.inf
+
+    def flush(self):
+        if self.store is not None:
+            self.buffer.flush_to(self.store)
+
+    def clear(self):
+        self.buffer.clear()
+        self.first = None
+        self._bucket = None
+        self._values = []
+        if self.store is not None:
+            self.store.clear()
+
+    def close(self):
+        if self.store is not None:
+            self.flush()
+            self.store.close()
+
+class Rollup:
+    """Tiers of progressively coarser history, updated incrementally from each new sample.
+
+    Queries pick the finest resolution whose number of points over the requested range
+    fits the point budget, so long histories stay cheap to keep and to draw.
+    """
+
+    def __init__(self, sample_file=None, tiers=DEFAULT_TIERS, capacity=50000):
+        self.tiers = [RollupTier(seconds, capacity, tier_path(sample_file, seconds) if sample_file else None)
+                      for seconds in tiers]
+
+    def prime(self, records):
+        """Bring the tiers up to date with the raw records, after a restart or a migration."""
+        for tier in self.tiers:
+            tier.prime(records['timestamp'], records['median'])
+
+    def add(self, timestamp, value):
+        for tier in self.tiers:
+            tier.add(timestamp, value)
+
+    def select(self, since, until, max_points, raw_points, raw_oldest=-np.inf):
+        """The tier to answer a query with, or None if the raw records cover it within the budget."""
+        tiers_oldest = min([tier.oldest() for tier in self.tiers], default=np.inf)
+        # The raw records answer whenever they fit and no tier reaches back further than them
+        if raw_points <= max_points and (since >= raw_oldest or tiers_oldest >= raw_oldest):
+            return None
+        start = max(since, min(raw_oldest, tiers_oldest))
+        for tier in self.tiers:
+            if (until - start) / tier.seconds <= max_points:
+                return tier
+        return self.tiers[-1] if self.tiers else None
+
+    def flush(self):
+        for tier in self.tiers:
+            tier.flush()
+
+    def clear(self):
+        for tier in self.tiers:
+            tier.clear()
+
+    def close(self):
+        for tier in self.tiers:
+            tier.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Build rollup tiers from a sample store, or time rollup queries")
+    parser.add_argument("store_file", type=str, help="Binary sample store")
+    parser.add_argument("-t", "--tiers", type=str, default=','.join(map(str, DEFAULT_TIERS)), help="Comma separated tier lengths in seconds")
+    parser.add_argument("-n", "--number", type=int, default=50000, help="Capacity of each tier in records")
+    parser.add_argument("-p", "--points", type=int, default=2000, help="Point budget of the timed queries")
+    args = parser.parse_args()
+
+    header = np.fromfile(args.store_file, dtype=HEADER_DTYPE, count=1)[0]
+    store = SampleStore(args.store_file, int(header['capacity']))
+    records = store.records()
+    store.close()
+
+    start = time.perf_counter()
+    rollup = Rollup(args.store_file, parse_tiers(args.tiers), args.number)
+    rollup.prime(records)
+    rollup.flush()
+    print(f"Rolled up {len(records)} samples in {time.perf_counter() - start:.3f} s")
+    for tier in rollup.tiers:
+        print(f"  {tier.seconds:>5} s tier: {len(tier.buffer)} records")
+
+    if len(records):
+        end = records['timestamp'][-1]
+        for hours in (1, 24, 24 * 7):
+            start = time.perf_counter()
+            since = end - hours * 3600
+            raw_points = len(records) - np.searchsorted(records['timestamp'], since, side='right')
+            tier = rollup.select(since, end, args.points, raw_points, records['timestamp'][0])
+            result = tier.records(since) if tier is not None else records[len(records) - raw_points:]
+            print(f"Last {hours:>3} h: {f'{tier.seconds} s' if tier else 'raw'} tier, "
+                  f"{len(result)} points in {1000 * (time.perf_counter() - start):.2f} ms")
+    rollup.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+#!/usr/bin/python3
+import argparse
+import os
+import zipfile
+
+import numpy as np
+
+MAGIC = b'HX4S'
+VERSION = 2
+CORNERS = 4
+
+# Fixed 64 byte header followed by `capacity` fixed size records
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S4'),
+    ('version', '<u4'),
+    ('capacity', '<u8'),
+    ('count', '<u8'),
+    ('reserved', 'V40'),
+])
+RECORD_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('median', '<f8'),
+    ('ci', '<f8'),
+    ('corners', '<f4', (CORNERS,)),
+])
+# Record layouts of earlier versions, which are migrated when opened
+RECORD_DTYPES = {
+    1: np.dtype([('timestamp', '<f8'), ('median', '<f8'), ('ci', '<f8')]),
+    VERSION: RECORD_DTYPE,
+}
+NO_CORNERS = np.full(CORNERS, np.nan, dtype='<f4')
+
+def upgrade_records(records):
+    """Convert records of an earlier version to RECORD_DTYPE, with unknown corners as NaN."""
+    upgraded = np.zeros(len(records), dtype=RECORD_DTYPE)
+    for name in records.dtype.names:
+        upgraded[name] = records[name]
+    if 'corners' not in records.dtype.names:
+        upgraded['corners'] = np.nan
+    return upgraded
+
+class SampleStore:
+    """Append-only binary ring buffer of per-window results, memory-mapped from `path`.
+
+    Appending writes one fixed size record in place and bumps the count in the header,
+    so the cost is independent of how much history is held.
+    """
+    magic = MAGIC
+    version = VERSION
+    record_dtype = RECORD_DTYPE
+    record_dtypes = RECORD_DTYPES
+
+    def __init__(self, path, capacity=10000):
+        self.path = path
+        self.capacity = int(capacity)
+        self._mmap = None
+        self.open()
+
+    def open(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= HEADER_DTYPE.itemsize:
+            header = np.fromfile(self.path, dtype=HEADER_DTYPE, count=1)[0]
+            version = int(header['version'])
+            if header['magic'] != self.magic or version not in self.record_dtypes:
+                raise ValueError(f"{self.path} is not a version {self.version} {type(self).__name__}")
+            if version != self.version or int(header['capacity']) != self.capacity:
+                self._rewrite(int(header['capacity']), version)
+        else:
+            self._create()
+        self._map()
+
+    def _create(self, records=None):
+        header = np.zeros(1, dtype=HEADER_DTYPE)
+        header['magic'] = self.magic
+        header['version'] = self.version
+        header['capacity'] = self.capacity
+        body = self.empty_records(self.capacity)
+        if records is not None and len(records):
+            records = records[-self.capacity:]
+            body[:len(records)] = records
+            header['count'] = len(records)
+
+        # Write to a temporary file and rename so an interrupted write cannot corrupt the store
+        tmp_file = self.path + ".tmp"
+        with open(tmp_file, 'wb') as f:
+            header.tofile(f)
+            body.tofile(f)
+        os.replace(tmp_file, self.path)
+
+    def empty_records(self, count):
+        records = np.zeros(count, dtype=self.record_dtype)
+        records['corners'] = np.nan
+        return records
+
+    def upgrade_records(self, records):
+        return upgrade_records(records)
+
+    def _rewrite(self, old_capacity, old_version=None):
+        if old_version is None:
+            old_version = self.version
+        if old_version != self.version:
+            print(f"Migrating {self.path} from version {old_version} to {self.version}")
+        if old_capacity != self.capacity:
+            print(f"Resizing {self.path} from {old_capacity} to {self.capacity} records")
+        old = type(self).__new__(type(self))
+        old.path = self.path
+        old.capacity = old_capacity
+        old._map(self.record_dtypes[old_version])
+        records = old.records()
+        if old_version != self.version:
+            records = self.upgrade_records(records)
+        old.close()
+        self._create(records)
+
+    def _map(self, record_dtype=None):
+        self._mmap = np.memmap(self.path, dtype=np.uint8, mode='r+')
+        self._header = self._mmap[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)
+        self._records = self._mmap[HEADER_DTYPE.itemsize:].view(record_dtype or self.record_dtype)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.flush()
+            del self._header, self._records
+            self._mmap = None
+
+    @property
+    def count(self):
+        return int(self._header['count'][0])
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, timestamp, median, ci, corners=NO_CORNERS):
+        count = self.count
+        self._records[count % self.capacity] = (timestamp, median, ci, corners)
+        self._header['count'] = count + 1
+
+    def extend(self, records):
+        """Append an array of records."""
+        records = np.asarray(records, dtype=self.record_dtype)[-self.capacity:]
+        count = self.count
+        positions = (count + np.arange(len(records))) % self.capacity
+        self._records[positions] = records
+        self._header['count'] = count + len(records)
+
+    def records(self):
+        """Return a chronologically ordered copy of the held records."""
+        count = self.count
+        if count <= self.capacity:
+            return np.array(self._records[:count])
+        head = count % self.capacity
+        return np.concatenate([self._records[head:], self._records[:head]])
+
+    def flush(self):
+        self._mmap.flush()
+
+    def clear(self):
+        self._header['count'] = 0
+        self.flush()
+
+class SampleBuffer:
+    """Preallocated in-memory ring buffer of RECORD_DTYPE (or `record_dtype`) records.
+
+    Every record is written twice, at `i` and `i + capacity`, so the most recent records
+    are always a contiguous slice and `records()` can return a view without copying.
+    """
+
+    def __init__(self, capacity=10000, record_dtype=RECORD_DTYPE):
+        self.capacity = int(capacity)
+        self._data = np.zeros(2 * self.capacity, dtype=record_dtype)
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self.unflushed = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, timestamp, median, ci, corners=NO_CORNERS):
+        self.append_record((timestamp, median, ci, corners))
+
+    def append_record(self, record):
+        position = self.count % self.capacity
+        self._data[position] = record
+        self._data[position + self.capacity] = record
+        self.count += 1
+        self.unflushed = min(self.unflushed + 1, self.capacity)
+
+    def extend(self, records):
+        records = np.asarray(records, dtype=self._data.dtype)
+        added = len(records)
+        records = records[-self.capacity:]
+        # The new records wrap around the end of the ring at most once, so two slice copies
+        # of each half do, much faster than indexing structured records by position
+        start = (self.count + added - len(records)) % self.capacity
+        first = min(len(records), self.capacity - start)
+        for offset in (0, self.capacity):
+            self._data[offset + start:offset + start + first] = records[:first]
+            self._data[offset:offset + len(records) - first] = records[first:]
+        self.count += added
+        self.unflushed = min(self.unflushed + added, self.capacity)
+
+    def records(self):
+        """Return a chronologically ordered view of the held records."""
+        end = self.count % self.capacity + (self.capacity if self.count >= self.capacity else 0)
+        return self._data[end - len(self):end]
+
+    def flush_to(self, store):
+        """Append the records added since the last flush to a SampleStore."""
+        if self.unflushed:
+            store.extend(self.records()[-self.unflushed:])
+            store.flush()
+            self.unflushed = 0
+
+def snapshot_path(sample_file):
+    """State derived from samples.bin, such as the smoothed series, is kept in samples.state.npz."""
+    root, ext = os.path.splitext(sample_file)
+    return f"{root}.state.npz"
+
+def save_snapshot(path, **arrays):
+    # Write to a temporary file and rename, like the store itself
+    tmp_file = path + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_file, path)
+
+def load_snapshot(path):
+    """The arrays of a snapshot, or None if there is none or it cannot be read."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+        print(f"Ignoring snapshot {path}: {e}")
+        return None
+
+def read_text(text_file, sample_duration=1.0):
+    """Records of a legacy samples.txt file of medians, with timestamps reconstructed as import_text does."""
+    medians = np.loadtxt(text_file, ndmin=1)
+    end_time = os.path.getmtime(text_file)
+    records = np.zeros(len(medians), dtype=RECORD_DTYPE)
+    records['timestamp'] = end_time - sample_duration * np.arange(len(medians))[::-1]
+    records['median'] = medians
+    records['ci'] = np.nan
+    records['corners'] = np.nan
+    return records
+
+def read_store(store_file):
+    """A copy of every record in a binary store, at whatever capacity it was created with."""
+    header = np.fromfile(store_file, dtype=HEADER_DTYPE, count=1)[0]
+    store = SampleStore(store_file, int(header['capacity']))
+    records = store.records()
+    store.close()
+    return records
+
+def import_text(text_file, store_file, capacity=10000, sample_duration=1.0):
+    """One-shot import of a legacy samples.txt file of medians into a binary store.
+
+    The text format has no timestamps, so they are reconstructed backwards from the
+    file's modification time at one record per `sample_duration` seconds.
+    """
+    records = read_text(text_file, sample_duration)
+    store = SampleStore(store_file, capacity)
+    store.extend(records)
+    store.flush()
+    print(f"Imported {len(records)} samples from {text_file} into {store_file}")
+    return store
+
+def export_text(store_file, text_file, medians_only=False):
+    records = read_store(store_file)
+    if medians_only:
+        np.savetxt(text_file, records['median'])
+    else:
+        np.savetxt(text_file, np.column_stack([records['timestamp'], records['median'], records['ci'], records['corners']]),
+                   header="timestamp median ci " + " ".join(f"corner{i}" for i in range(CORNERS)))
+    print(f"Exported {len(records)} samples from {store_file} to {text_file}")
+
+def open_store(store_file, capacity, legacy_file=None, sample_duration=1.0):
+    """Open the binary store, importing a legacy text file the first time if one exists."""
+    if not os.path.exists(store_file) and legacy_file and os.path.exists(legacy_file) and os.path.getsize(legacy_file) > 0:
+        try:
+            return import_text(legacy_file, store_file, capacity, sample_duration)
+        except Exception as e:
+            print(f"Failed to import {legacy_file}", e)
+    return SampleStore(store_file, capacity)
+
+def main():
+    parser = argparse.ArgumentParser(description="Import or export binary sample stores")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = subparsers.add_parser('import', help="Import a samples.txt file into a binary store")
+    import_parser.add_argument("text_file", type=str, help="Text file with one median per line")
+    import_parser.add_argument("store_file", type=str, help="Binary store to create or append to")
+    import_parser.add_argument("-n", "--number", type=int, default=10000, help="Capacity of the store in samples")
+    import_parser.add_argument("-d", "--duration", type=float, default=1.0, help="Sample duration in seconds, used to reconstruct timestamps")
+
+    export_parser = subparsers.add_parser('export', help="Export a binary store to text")
+    export_parser.add_argument("store_file", type=str, help="Binary store to read")
+    export_parser.add_argument("text_file", type=str, help="Text file to write")
+    export_parser.add_argument("-m", "--medians-only", action='store_true', help="Write only the medians, in the legacy samples.txt format")
+
+    args = parser.parse_args()
+    if args.command == 'import':
+        import_text(args.text_file, args.store_file, args.number, args.duration).close()
+    else:
+        export_text(args.store_file, args.text_file, args.medians_only)
+
+if __name__ == "__main__":
+    main()
@@ -1,190 +1,470 @@
 import os
 import time
-import datetime
+import threading
 import traceback
 import numpy as np
-import RPi.GPIO as GPIO
-from hx711 import HX711
 
-from collections import deque
-import numpy as np
-from scipy.signal import wiener, medfilt
-
-import matplotlib.pyplot as plt
-from matplotlib.ticker import MaxNLocator
-
-from scipy.optimize import root_scalar
-from concurrent.futures import ThreadPoolExecutor
+from sensors import create_sensors, release_gpio, DEFAULT_PINS
+from acquisition import AcquisitionEngine, AdaptiveWindow, HampelFilter
+from sample_store import open_store, SampleStore, SampleBuffer, HEADER_DTYPE, RECORD_DTYPE, snapshot_path, save_snapshot, load_snapshot
+from confidence import make_ci_estimator, reference_bootstrap_ci
+from smoothing import StreamingSmoother, effective_window, filter_data, smooth_series, MAD_TO_SIGMA
+from renderer import ChartRenderer, minmax_indices
+from rollup import Rollup, DEFAULT_TIERS, tier_path
+from broadcast import Broadcaster
+from metrics import instrumentation, startup
+from corners import CornerMonitor, analyze_window, corner_factors, corner_loads
+from forecast import SpoolForecaster
+from calibration import CalibrationSession, ZeroTracker
+
+def warm_up():
+    """Import the filtering and plotting modules, which take seconds on a Pi, off the startup path."""
+    import scipy.signal
+    import scipy.ndimage
+    import matplotlib.figure
+    import matplotlib.backends.backend_agg
+    startup.mark('warm_up')
 
 class Scale:
-    def __init__(self):
-        self.sensors = [
-            self.initialize_sensor(5, 6),
-            self.initialize_sensor(17, 18),
-            self.initialize_sensor(19, 20),
-            self.initialize_sensor(23, 22)
-        ]
-
-    def initialize_sensor(self, dout_pin, pd_sck_pin):
-        sensor = HX711(dout_pin=dout_pin, pd_sck_pin=pd_sck_pin)
-        sensor.min_measures = 1
-        sensor.reset()
-        return sensor
+    def __init__(self, backend='hx711', ci_method='order', pins=DEFAULT_PINS, scheduler=None, name=None,
+                 rollup_tiers=DEFAULT_TIERS, rollup_capacity=50000, sensor_options=None, forecast_minutes=10,
+                 frame_source=None, reject_sigma=6.0, reject_window=15):
+        self.backend = backend
+        self.sensor_options = sensor_options or {}
+        self.name = name
+        self.rollup_tiers = rollup_tiers
+        self.rollup_capacity = rollup_capacity
+        self.forecast_minutes = forecast_minutes
+        self.ci_estimator = make_ci_estimator(ci_method)
+        self.store = None
+        self.samples = None
+        self.rollup = None
+        self.forecaster = None
+        self.forecast = None
+        self.smoother = None
+        self.smoothed_count = 0
+        self.chart = None
+        self.smoothed_data = None
+        self.lock = threading.Lock()
+        self.events = Broadcaster()
+        self.last_sample_count = 0
+        self.last_flush = time.monotonic()
+        if frame_source is not None:
+            # Frames come from an acquisition process, which owns the sensors and GPIO
+            self.sensors = None
+            self.acquisition = frame_source
+        else:
+            # Reset every load cell at once rather than waiting for each in turn
+            self.sensors = create_sensors(pins, self.backend, **self.sensor_options)
+            # Readers live for the life of the Scale rather than per sample, either on their own
+            # threads or on a scheduler shared with other scales
+            self.acquisition = AcquisitionEngine(self.sensors, scheduler=scheduler, name=name)
+        self.corner_monitor = CornerMonitor(self.acquisition.channels, name=name)
+        # Glitched reads are dropped from every block before anything else sees them
+        self.read_filter = None
+        if reject_sigma > 0:
+            self.read_filter = HampelFilter(reject_window, reject_sigma, name=name)
+        self.corner_summary = None
+        self.adaptive_window = None
+        self.calibration = None
+        self.calibration_fit = None
+        self.zero_tracker = None
+        self.auto_tare = None
+        self.acquisition.start()
 
     def get_sensor_data(self, sensor):
         return sensor.get_raw_data(times=1)[0]
 
     def collect_sample(self):
-        with ThreadPoolExecutor() as executor:
-            # Schedule the get_sensor_data function to be called on each sensor
-            futures = [executor.submit(self.get_sensor_data, sensor) for sensor in self.sensors]
-            # Collect results as they are completed
-            readings = [future.result() for future in futures]
+        timestamp, readings = self.acquisition.get_frame()
         return sum(readings)
 
-    #def collect_sample(self):
-    #    readings = [sensor.get_raw_data(times=1)[0] for sensor in self.sensors]
-    #    return sum(readings)
-
-    def collect_samples(self, sample_duration):
-        end_time = time.time() + sample_duration
-        samples = []
-        while time.time() < end_time:
-            samples.append(self.collect_sample())
-        return np.array(samples)
+    def collect_block(self, sample_duration, interrupt=None, done=None):
+        # Timestamps and an (n, 4) int32 block holding every corner's readings
+        timestamps, block = self.acquisition.read_frames(sample_duration, interrupt, done)
+        if self.read_filter is not None:
+            with instrumentation.stage('reject', self.name):
+                timestamps, block = self.read_filter.apply(timestamps, block)
+            if interrupt is not None and interrupt.is_set():
+                self.read_filter.reset()
+        return timestamps, block
+
+    def precision_reached(self, target, min_duration, scale_factor, tare_value, corner_tare, corner_scale):
+        """A check for read_frames that ends the window once its median is known to within `target`.
+
+        The interval is the one measure will report: the frames the read filter would drop
+        are left out, the rest converted to weights corner by corner, and the interval taken
+        by the configured estimator.
+        """
+        start = time.monotonic()
+        def done(timestamps, block):
+            if time.monotonic() - start < min_duration:
+                return False
+            if self.read_filter is not None:
+                block = block[~self.read_filter.outliers(block).any(axis=1)]
+            if len(block) == 0:
+                return False
+            samples = self.weight_from_block(block, scale_factor, tare_value, corner_tare, corner_scale)
+            lower, upper = self.confidence_interval(samples)
+            return upper - lower <= target
+        return done
+
+    def collect_samples(self, sample_duration, interrupt=None):
+        timestamps, block = self.collect_block(sample_duration, interrupt)
+        return block.sum(axis=1, dtype=np.int64)
+
+    @property
+    def samples_per_second(self):
+        return self.acquisition.samples_per_second
 
     def tare(self, sample_duration):
+        # Returns the tare of the total and of each corner, and starts a calibration session from it
         print("Taring the scale. Ensure the scale is empty.")
-        tare_value = np.median(self.collect_samples(sample_duration))
-        return tare_value
-
-    def calibrate(self, known_weight, sample_duration):
+        timestamps, block = self.collect_block(sample_duration)
+        tare_value = np.median(block.sum(axis=1, dtype=np.int64))
+        corner_tare = np.median(block, axis=0)
+        self.calibration = CalibrationSession(block.shape[1])
+        self.calibration.add(0.0, block)
+        return tare_value, corner_tare
+
+    def calibrate(self, known_weight, sample_duration, tare_value=0, corner_tare=None, per_corner=True):
+        """Add a known-weight point to the calibration session and refit it, returning the fit or None."""
+        if not np.isfinite(known_weight):
+            print(f"Cannot calibrate to {known_weight}")
+            return None
         print(f"Place a known weight of {known_weight} units on the scale.")
-        reading_with_weight = np.median(self.collect_samples(sample_duration))
-        scale_factor = known_weight / (reading_with_weight - tare_value)
-        return scale_factor
-        
+        timestamps, block = self.collect_block(sample_duration)
+        if len(block) == 0:
+            print("No samples collected")
+            return None
+        if self.calibration is None:
+            self.calibration = CalibrationSession(block.shape[1])
+        self.calibration.add(known_weight, block)
+        fit = self.calibration.fit(tare_value, corner_tare, per_corner)
+        if fit is not None:
+            self.calibration_fit = fit
+        return fit
+
+    def load_samples(self, sample_file, buffer_length, legacy_file=None, sample_duration=1.0):
+        # The history lives in memory for the whole process, and is only loaded from
+        # disk at startup, after a clear, or if the path or length changes
+        if self.store is not None and self.store.path == sample_file and self.store.capacity == buffer_length:
+            return self.samples
+
+        first_load = self.store is None
+        if self.store is not None:
+            self.flush_samples()
+            self.save_snapshot()
+            self.store.close()
+            self.rollup.close()
+        self.store = open_store(sample_file, buffer_length, legacy_file, sample_duration)
+        self.samples = SampleBuffer(buffer_length)
+        self.samples.extend(self.store.records())
+        self.samples.unflushed = 0
+
+        # Coarser tiers keep the history that no longer fits in the raw buffer
+        self.rollup = Rollup(sample_file, self.rollup_tiers, self.rollup_capacity)
+        self.rollup.prime(self.samples.records())
+        self.smoother = None
+        if not self.restore_snapshot():
+            self.reset_forecast(self.samples.records())
+        self.last_flush = time.monotonic()
+        if first_load:
+            startup.mark('history', self.name)
+        return self.samples
+
+    def flush_samples(self, flush_interval=0):
+        # Write new records to disk in batches, only for durability
+        if self.store is None or self.samples is None:
+            return
+        now = time.monotonic()
+        if now - self.last_flush >= flush_interval:
+            self.samples.flush_to(self.store)
+            self.rollup.flush()
+            self.last_flush = now
+
+    def save_snapshot(self):
+        # The smoother and forecaster are derived from the history, but slow to rebuild from it
+        if self.store is None:
+            return
+        snapshot = {'count': self.store.count, 'last_timestamp': self.last_timestamp()}
+        snapshot.update((f"forecast_{name}", value) for name, value in self.forecaster.snapshot().items())
+        if self.smoother is not None and self.smoothed_count == self.samples.count:
+            snapshot.update((f"smoother_{name}", value) for name, value in self.smoother.snapshot().items())
+        try:
+            save_snapshot(snapshot_path(self.store.path), **snapshot)
+        except OSError as e:
+            print("Failed to save snapshot", e)
+
+    def restore_snapshot(self):
+        """Continue from the snapshot saved at shutdown, if it matches the history on disk."""
+        snapshot = load_snapshot(snapshot_path(self.store.path))
+        if snapshot is None:
+            return False
+        if int(snapshot['count']) != self.store.count or not np.array_equal(snapshot['last_timestamp'], self.last_timestamp(), equal_nan=True):
+            print("Snapshot does not match the sample store, rebuilding")
+            return False
+
+        self.reset_forecast()
+        self.forecaster.restore({name[len('forecast_'):]: value for name, value in snapshot.items() if name.startswith('forecast_')})
+        if 'smoother_count' in snapshot and int(snapshot['smoother_capacity']) == self.samples.capacity:
+            window = int(snapshot['smoother_window'])
+            self.smoother = StreamingSmoother(self.samples.capacity, window, window)
+            self.smoother.restore({name[len('smoother_'):]: value for name, value in snapshot.items() if name.startswith('smoother_')})
+            self.smoothed_count = self.samples.count
+        return True
+
+    def last_timestamp(self):
+        records = self.samples.records()
+        return records['timestamp'][-1] if len(records) else np.nan
+
+    def reset_forecast(self, records=None):
+        # The forecast is updated per sample, so it only needs the recent history once
+        self.forecaster = SpoolForecaster(self.forecast_minutes * 60)
+        self.forecast = None
+        if records is not None:
+            self.forecaster.prime(records['timestamp'], records['median'])
+
+    def samples_since(self, since=0.0, max_points=None):
+        """Copy of the history newer than `since`, decimated to about `max_points`.
+
+        Ranges with more raw records than `max_points`, or reaching back past the raw buffer,
+        are answered from the finest rollup tier that fits. Returns the records, the smoothed
+        weights and the tier's bucket length in seconds, 0 for raw records.
+        """
+        with self.lock:
+            if self.samples is None:
+                return np.zeros(0, dtype=RECORD_DTYPE), np.zeros(0), 0
+            records = self.samples.records()
+            start = np.searchsorted(records['timestamp'], since, side='right')
+            tier = None
+            if max_points:
+                raw_oldest = records['timestamp'][0] if len(records) else np.inf
+                tier = self.rollup.select(since, time.time(), max_points, len(records) - start, raw_oldest)
+
+            if tier is None:
+                smoothed = self.smoothed_data if self.smoothed_data is not None else records['median']
+                smoothed = smoothed[-len(records):]
+                if len(smoothed) != len(records):
+                    smoothed = records['median']
+                records = np.array(records[start:])
+                smoothed = np.array(smoothed[start:])
+            else:
+                # Buckets are drawn at their centre, with their range as the interval
+                buckets = tier.records(since)
+                records = np.zeros(len(buckets), dtype=RECORD_DTYPE)
+                records['timestamp'] = buckets['timestamp'] + tier.seconds / 2
+                records['median'] = buckets['median']
+                records['ci'] = buckets['max'] - buckets['min']
+                records['corners'] = np.nan
+                smoothed = np.array(buckets['median'])
+
+        if max_points and len(records) > max_points:
+            indices = minmax_indices(records['median'], max_points)
+            records = records[indices]
+            smoothed = smoothed[indices]
+        return records, smoothed, tier.seconds if tier is not None else 0
+
+    def clear_samples(self, sample_file):
+        # Only the binary store and what is derived from it: the legacy text file may be replay input
+        if self.store is not None and self.store.path == sample_file:
+            with self.lock:
+                self.store.clear()
+                self.samples.clear()
+                self.rollup.clear()
+                self.reset_forecast()
+                self.smoother = None
+                self.smoothed_data = None
+        else:
+            if os.path.exists(sample_file):
+                # Emptied rather than removed, so the legacy text file is not imported into it again
+                header = np.fromfile(sample_file, dtype=HEADER_DTYPE, count=1)[0]
+                store = SampleStore(sample_file, int(header['capacity']))
+                store.clear()
+                store.close()
+            paths = [snapshot_path(sample_file)] + [tier_path(sample_file, seconds) for seconds in self.rollup_tiers]
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
     def weight_from_raw(self, samples, scale_factor, tare_value):
         return (samples - tare_value) * scale_factor
+
+    def weight_from_block(self, block, scale_factor, tare_value, corner_tare, corner_scale):
+        # Once calibration has fitted each corner its own gain, the weight is the sum of the corner loads
+        if np.ptp(corner_scale) > 0:
+            return corner_loads(block, corner_tare, corner_scale).sum(axis=1)
+        return self.weight_from_raw(block.sum(axis=1, dtype=np.int64), scale_factor, tare_value)
         
     def bootstrap_confidence_interval(self, data, n_bootstraps=1000, ci=95):
-        bootstrapped_samples = np.random.choice(data, (n_bootstraps, len(data)), replace=True)
-        bootstrapped_medians = np.median(bootstrapped_samples, axis=1)
-        lower_bound = np.percentile(bootstrapped_medians, (100 - ci) / 2)
-        upper_bound = np.percentile(bootstrapped_medians, 100 - (100 - ci) / 2)
-        return lower_bound, upper_bound
+        return reference_bootstrap_ci(data, n_bootstraps, ci)
+
+    def confidence_interval(self, data, ci=95):
+        # Median confidence interval using the configured estimator
+        return self.ci_estimator(data, ci)
     
     def filter_data(self, data, window):
-        # Ensure the window size is odd
-        if window % 2 == 0:
-            window = window + 1
-        
-        for i in range(3):
-            # Apply initial filter
-            if window > 1:
-                data_filtered = medfilt(data, window)
-            else:
-                data_filtered = data                
-        
-            # Identify and remove outliers
-            delta = np.abs(data_filtered - data)
-            sigma = np.std(delta)
-            outliers = delta < 3*sigma
-            data_cleaned = np.array(data)
-            data_cleaned[outliers] = data_filtered[outliers]
-            
-            # Reapply Wiener filter on cleaned data
-            if len(data_cleaned) > window:
-                data_final_filtered = wiener(data_cleaned, window)
-            else:
-                data_final_filtered = data
-                
-            data = np.array(data_filtered)
-            data_filtered = np.array(data_final_filtered)
-        
-        return data_final_filtered, sigma
-          
+        return filter_data(data, window)
+    
     def measure(self, 
         sample_duration=10, 
         scale_factor=1, 
         tare_value=0, 
-        sample_file="samples.txt", 
+        sample_file="samples.bin", 
         buffer_length=10000, 
-        low_pass_minutes=10 ):
+        low_pass_minutes=10,
+        legacy_file=None,
+        flush_interval=60,
+        smoothing='incremental',
+        max_window=301,
+        interrupt=None,
+        corner_tare=None,
+        corner_scale=None,
+        density_gcm3=1.07,
+        diameter_mm=1.75,
+        empty_weight=0.0,
+        precision_target=0.0,
+        min_duration=0.0,
+        adaptive=False,
+        auto_zero_band=0.0,
+        auto_zero_threshold=0.2,
+        auto_zero_minutes=10.0 ):
         
-        # Check if the file exists and is not empty
-        if os.path.exists(sample_file) and os.path.getsize(sample_file) > 0:
-            try:
-                # Load the file content
-                file_buffer = np.loadtxt(sample_file, ndmin=1)  # Ensure at least 1D array is returned
-                sample_buffer = deque(file_buffer, maxlen=buffer_length)
-            except Exception as e:
-                print(e)
-                sample_buffer = deque(maxlen=buffer_length)  # Circular buffer for samples
-        else:
-            sample_buffer = deque(maxlen=buffer_length)  # Initialize an empty buffer if file doesn't exist or is empty
-
-        samples = self.collect_samples(sample_duration)
-        samples = self.weight_from_raw(samples, scale_factor, tare_value)
-        median_value = np.median(samples)
-        lower_bound, upper_bound = self.bootstrap_confidence_interval(samples)
+        buffer = self.load_samples(sample_file, buffer_length, legacy_file, sample_duration)
+
+        # `sample_duration` is the longest window; adaptive windows and the precision target shorten it
+        window_duration = sample_duration
+        if adaptive:
+            if (self.adaptive_window is None or self.adaptive_window.max_duration != sample_duration
+                    or self.adaptive_window.min_duration != min(min_duration, sample_duration)):
+                self.adaptive_window = AdaptiveWindow(min_duration, sample_duration)
+            window_duration = self.adaptive_window.duration
+        corner_tare = corner_factors(corner_tare, tare_value)
+        corner_scale = corner_factors(corner_scale, scale_factor, share=False)
+        done = None
+        if precision_target > 0:
+            done = self.precision_reached(precision_target, min_duration, scale_factor, tare_value, corner_tare, corner_scale)
+
+        window_start = time.monotonic()
+        # This thread's CPU time only, as the acquisition and HTTP threads share the process
+        cpu_start = time.thread_time()
+        with instrumentation.stage('collect', self.name):
+            timestamps, block = self.collect_block(window_duration, interrupt, done)
+        if interrupt is not None and interrupt.is_set():
+            # A command arrived, drop the partial window
+            return None
+        self.last_sample_count = len(block)
+        if len(block) == 0:
+            print("No samples collected")
+            return None
+        with instrumentation.stage('convert', self.name):
+            samples = self.weight_from_block(block, scale_factor, tare_value, corner_tare, corner_scale)
+            median_value = np.median(samples)
+        with instrumentation.stage('corners', self.name):
+            self.corner_summary = analyze_window(timestamps, block, corner_tare, corner_scale, self.corner_monitor)
+        with instrumentation.stage('ci', self.name):
+            lower_bound, upper_bound = self.confidence_interval(samples)
         sigma = upper_bound - lower_bound
-        significant_figures = int(-np.floor(np.log10(sigma)))
+        instrumentation.record_window(time.monotonic() - window_start, sigma, time.thread_time() - cpu_start, self.name)
+        if adaptive:
+            self.adaptive_window.update(median_value, sigma)
+        if auto_zero_band > 0:
+            self.track_zero(block, median_value, sigma, tare_value, corner_tare, corner_scale,
+                            auto_zero_band, auto_zero_threshold, auto_zero_minutes)
+        significant_figures = int(-np.floor(np.log10(sigma))) if sigma > 0 else 1
         significant_figures = max(1,significant_figures)
         formatted_median = float(f"{median_value:.{significant_figures}f}")
         formatted_range = float(f"{sigma:.{significant_figures}f}")
-        sample_buffer.append(formatted_median)
-
-        # Append the result to the circular buffer and save to file
-        if sample_file != None:
-            # When saving, ensure the data is in an array format, especially if it's a single value
-            np.savetxt(sample_file, list(sample_buffer))
-        
-        # Create a time array that corresponds to each sample
-        total_samples = len(sample_buffer)
-        time_array = np.linspace(0, sample_duration*total_samples/60, total_samples)
-        
-        # Filter the data to reduce noise
-        try:
-            b = np.array(sample_buffer)
 
+        # Append the result and update the smoothing under the lock, so HTTP readers
+        # always see a consistent history
+        timestamp = time.time()
+        with self.lock:
+            with instrumentation.stage('store', self.name):
+                buffer.append(timestamp, formatted_median, formatted_range, self.corner_summary['corners'])
+                self.rollup.add(timestamp, formatted_median)
+                self.flush_samples(flush_interval)
+            with instrumentation.stage('forecast', self.name):
+                self.forecaster.update(timestamp, formatted_median)
+                self.forecast = self.forecaster.report(density_gcm3, diameter_mm, empty_weight)
+            records = buffer.records()
+            sample_buffer = records['median']
+
+            # Create a time array in minutes that corresponds to each sample
+            time_array = (records['timestamp'] - records['timestamp'][0]) / 60
+            
+            # Filter the data to reduce noise
             window = int(low_pass_minutes * 60 / sample_duration)
-            if window>5 and len(sample_buffer)>window:
-                window = int(len(sample_buffer) / 2)
-            else:
-                print(f"window={window}<=5 or len(sample_buffer)={len(sample_buffer)}<={window}")
-                return time_array, sample_buffer, b
-
-            # Ensure the window size is odd
-            if window % 2 == 0:
-                window = window + 1
-                
-            # Correctly reflect and append data at both ends
-            # Reflect the start of the array and append to the beginning
-            start_reflection = 2.0*b[0] - b[:window][::-1]
-            # Reflect the end of the array and append to the end
-            end_reflection = 2.0*b[-1] - b[-window:][::-1]
-
-            # Combine start reflection, original array, and end reflection
-            b_reflected = np.concatenate([start_reflection, b, end_reflection])
-
-            # Apply Wiener filter
-            b_filtered, sigma = self.filter_data(b_reflected, window)
-
-            # Remove the reflected parts to get the smoothed data of original length
-            smoothed_data = b_filtered[window:-window]
-
-        except Exception as e:
-            print("Exception in Scale.plot", e)
-            traceback.print_exc()
-            smoothed_data = np.array(sample_buffer)
+            with instrumentation.stage('smooth', self.name):
+                try:
+                    if smoothing == 'full':
+                        result = self.smooth_full(sample_buffer, window, max_window)
+                        if result is None:
+                            smoothed_data = np.array(sample_buffer)
+                        else:
+                            smoothed_data, sigma = result
+                    else:
+                        smoothed_data = self.smooth_incremental(sample_buffer, window, max_window)
+                        sigma = self.smoother.sigma
+
+                except Exception as e:
+                    print("Exception in Scale.measure", e)
+                    traceback.print_exc()
+                    smoothed_data = np.array(sample_buffer)
+
+            self.smoothed_data = smoothed_data
+
+        with instrumentation.stage('publish', self.name):
+            self.events.publish({
+                'timestamp': timestamp,
+                'median': formatted_median,
+                'ci': formatted_range,
+                'smoothed': float(smoothed_data[-1]),
+                'corners': np.round(self.corner_summary['corners'], 3).tolist(),
+                'center': np.round(np.nan_to_num(self.corner_summary['center']), 3).tolist(),
+                'drift': np.round(self.corner_summary['drift'], 4).tolist(),
+                'faults': self.corner_summary['faults'],
+                'forecast': self.forecast,
+            })
 
         # Output the result
         formatted_range = float(f"{sigma:.{significant_figures}f}")
-        print(f"{formatted_median} {formatted_range}", flush=True)
+        print(f"{formatted_median} {formatted_range} ({self.samples_per_second:.1f} samples/s)", flush=True)
                 
         return time_array, sample_buffer, smoothed_data
         
+    def track_zero(self, block, weight, ci, tare_value, corner_tare, corner_scale, zero_band, threshold, minutes):
+        # Leaves a re-tare in `auto_tare` for the state machine to save
+        tracker = self.zero_tracker
+        if tracker is None or (tracker.zero_band, tracker.threshold, tracker.time_constant) != (zero_band, threshold, 60 * minutes):
+            tracker = self.zero_tracker = ZeroTracker(zero_band, threshold, 60 * minutes, self.name)
+        retare = tracker.update(time.time(), weight, ci, np.median(block, axis=0), tare_value, corner_tare, corner_scale)
+        if retare is not None:
+            self.auto_tare = retare
+
+    def smooth_incremental(self, sample_buffer, window, max_window=301):
+        # Update the smoothed series from the newest sample only, priming from the
+        # whole history at startup, after a clear, or when the window changes
+        smoother = self.smoother
+        if (smoother is None or smoother.capacity != self.samples.capacity
+                or smoother.window != effective_window(window, max_window)
+                or self.smoothed_count + 1 != self.samples.count):
+            smoother = StreamingSmoother(self.samples.capacity, window, max_window)
+            smoother.prime(sample_buffer)
+            self.smoother = smoother
+        else:
+            smoother.update(sample_buffer[-1])
+        self.smoothed_count = self.samples.count
+        return smoother.smoothed()
+
+    def smooth_full(self, sample_buffer, window, max_window=301):
+        # Re-smooth the whole history in one batch with the incremental smoother's algorithm,
+        # as the reference it is validated against and a fallback
+        if len(sample_buffer) < 2:
+            return None
+        smoothed, _, noise = smooth_series(sample_buffer, effective_window(window, max_window))
+        return smoothed, MAD_TO_SIGMA * noise[-1]
+
     def plot(self, time_array, sample_buffer, smoothed_data, plot_file="samples.png", density_gcm3 = 1.07, diameter_mm = 1.75):
         # Saving the plot if a filename is provided
         if plot_file is None:
@@ -195,72 +475,23 @@ class Scale:
             return
             
         try:
-            # Calculate a margin for the y-axis range for better visualization
-            margin = (smoothed_data.max() - smoothed_data.min()) * 0.05  # 5% margin            
-
-            # Constants for ASA filament
-            radius_cm = diameter_mm / 2.0 / 10.0  # Convert mm to cm
-            volume_per_cm = np.pi * radius_cm**2  # Volume per cm of filament
-
-            # Calculate weight to length conversion (cm per g)
-            length_per_g = 1 / (volume_per_cm * density_gcm3)
-
-            # Convert smoothed weight data to length (assuming weight is in grams)
-            smoothed_length = smoothed_data * length_per_g / 100.0  # Convert cm to meters
-
-            # Use the original time_array for plotting since we've adjusted smoothed_data to match its length
-            plt.figure(figsize=(10, 6))
-            plt.scatter(time_array, sample_buffer, label='Raw Weight (g)', alpha=0.9, s=10, color='gray')  # Plot raw data as dots
-            plt.plot(time_array, smoothed_data, label='Smoothed Weight (g)', color='blue')  # Plot smoothed (and padded) data as a line
-            plt.xlabel('Time (min)')
-            plt.ylabel('Weight (g)')
-            plt.title('Weight Measurement Over Time')
-            plt.gca().yaxis.set_major_locator(MaxNLocator(integer=True, nbins=10))
-            plt.ylim(smoothed_data.min() - margin, smoothed_data.max() + margin)
-
-            # Create secondary y-axis (length)
-            ax2 = plt.gca().twinx()
-            ax2.plot(time_array, smoothed_length, label='Filament Length (m)', color='blue')
-            ax2.set_ylabel('Length (m)')
-            ax2.yaxis.set_major_locator(MaxNLocator(nbins=10))
-
-            plt.show()
-
-            tmp_file = plot_file + ".tmp.png"
-            plt.savefig(tmp_file)
-            plt.close()
-
-            # Rename the temporary file to the final filename, ensuring overwrite
-            if os.path.exists(plot_file):
-                os.remove(plot_file)
-            os.rename(tmp_file, plot_file)
+            # Render synchronously with the same persistent figure the background renderer uses
+            if self.chart is None:
+                self.chart = ChartRenderer()
+            self.chart.render(np.asarray(time_array), np.asarray(sample_buffer), np.asarray(smoothed_data), plot_file, density_gcm3, diameter_mm)
 
         except Exception as e:
             print("Exception in Scale.plot", e)
             traceback.print_exc()
         
-    def estime_time_to_zero(self, sample_duration, smoothed_data):
-        try:
-            # Estimate the time until zero
-            # Calculate gradients between consecutive points
-            gradients = np.diff(smoothed_data) / sample_duration  # Assuming time_array is in minutes
-            median_gradient = np.median(gradients)
-
-            if median_gradient >= 0 and median_gradient==np.inf and not median_gradient==np.nan:
-                time_to_zero = -smoothed_data[-1] / median_gradient
-            else:
-                time_to_zero = 0
-                
-            time_to_zero_timedelta = datetime.timedelta(minutes=time_to_zero)
-            estimated_zero_datetime = datetime.datetime.now() + time_to_zero_timedelta
-
-            return time_to_zero_timedelta, estimated_zero_datetime
-
-        except Exception as e:
-            print("Exception in Scale.plot", e)
-            traceback.print_exc()
-        
-            return np.inf, datetime.datetime.now()
-            
     def cleanup(self):
-        GPIO.cleanup()
+        self.acquisition.stop()
+        if self.store is not None:
+            self.flush_samples()
+            self.save_snapshot()
+            self.store.close()
+            self.rollup.close()
+        # With a shared scheduler, GPIO is released once all the scales have stopped, and
+        # without sensors of its own, by the acquisition process
+        if self.sensors is not None and self.acquisition.scheduler is None:
+            release_gpio(self.backend)
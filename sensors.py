@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+import argparse
+import random
+import threading
+import time
+
+import numpy as np
+
+SENSOR_BACKENDS = ('hx711', 'fake', 'replay')
+
+# GPIO (dout, pd_sck) pin pairs of the four load cells of a single scale
+DEFAULT_PINS = ((5, 6), (17, 18), (19, 20), (23, 22))
+
+class FakeHX711:
+    """Simulated HX711 exposing the same read interface as hx711.HX711, for running without GPIO."""
+
+    def __init__(self, dout_pin, pd_sck_pin, offset=500000, noise=200.0, sample_rate=80.0, seed=None):
+        self.dout_pin = dout_pin
+        self.pd_sck_pin = pd_sck_pin
+        self.offset = offset
+        self.noise = noise
+        # HX711 output data rate is 10 or 80 SPS; 0 reads as fast as possible
+        self.sample_rate = sample_rate
+        self.min_measures = 1
+        self._random = random.Random(seed if seed is not None else dout_pin)
+        self._next_ready = time.monotonic()
+
+    def reset(self):
+        self._next_ready = time.monotonic()
+        return False
+
+    def _ready(self):
+        return self.sample_rate <= 0 or time.monotonic() >= self._next_ready
+
+    def _wait_ready(self):
+        if self.sample_rate <= 0:
+            return
+        period = 1.0 / self.sample_rate
+        delay = self._next_ready - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+            self._next_ready += period
+        else:
+            # Conversions run on the chip's own clock, so a late read waits for the next one
+            self._next_ready += period * (int(-delay / period) + 1)
+
+    def get_raw_data(self, times=5):
+        data_list = []
+        for _ in range(times):
+            self._wait_ready()
+            data_list.append(int(self._random.gauss(self.offset, self.noise)))
+        return data_list
+
+_captures = {}
+_captures_lock = threading.Lock()
+
+def load_capture(capture_file, tare_value=0.0, scale_factor=1.0, channels=4):
+    """Load recorded raw readings as an (n, channels) int32 array, shared between sensors.
+
+    A .npy file or a text file with one column per channel holds raw readings as
+    recorded by `python sensors.py capture`. A text file with a single column, such as
+    samples.txt, holds weights, which are converted back to raw totals with `tare_value`
+    and `scale_factor` and split evenly between the channels.
+    """
+    key = (capture_file, tare_value, scale_factor, channels)
+    with _captures_lock:
+        if key not in _captures:
+            if capture_file.endswith('.npy'):
+                data = np.load(capture_file)
+            else:
+                data = np.loadtxt(capture_file, ndmin=2)
+            if data.shape[1] == 1:
+                raw = data[:, 0] / scale_factor + tare_value
+                data = np.repeat(raw[:, None] / channels, channels, axis=1)
+            if data.shape[1] != channels:
+                raise ValueError(f"{capture_file} has {data.shape[1]} columns, expected 1 or {channels}")
+            _captures[key] = np.round(data).astype(np.int32)
+        return _captures[key]
+
+class ReplayHX711:
+    """Plays back one channel of a recorded capture, at `sample_rate` or as fast as possible when 0.
+
+    The capture loops when it runs out, so replays can run for as long as needed.
+    """
+
+    def __init__(self, dout_pin, pd_sck_pin, capture, channel=0, sample_rate=80.0, tare_value=0.0, scale_factor=1.0):
+        self.dout_pin = dout_pin
+        self.pd_sck_pin = pd_sck_pin
+        self.readings = load_capture(capture, tare_value, scale_factor)[:, channel]
+        self.sample_rate = sample_rate
+        self.min_measures = 1
+        self.position = 0
+        self._clock = FakeHX711(dout_pin, pd_sck_pin, sample_rate=sample_rate)
+
+    def reset(self):
+        self.position = 0
+        return self._clock.reset()
+
+    def _ready(self):
+        return self._clock._ready()
+
+    def get_raw_data(self, times=5):
+        data_list = []
+        for _ in range(times):
+            self._clock._wait_ready()
+            data_list.append(int(self.readings[self.position % len(self.readings)]))
+            self.position += 1
+        return data_list
+
+def create_sensor(dout_pin, pd_sck_pin, backend='hx711', channel=0, **kwargs):
+    """Construct and reset one load cell amplifier using the named backend.
+
+    `channel` is the sensor's position in its scale, which the replay backend uses
+    to pick its column of the capture.
+    """
+    if backend == 'hx711':
+        from hx711 import HX711
+        sensor = HX711(dout_pin=dout_pin, pd_sck_pin=pd_sck_pin)
+    elif backend == 'fake':
+        sensor = FakeHX711(dout_pin, pd_sck_pin, **kwargs)
+    elif backend == 'replay':
+        sensor = ReplayHX711(dout_pin, pd_sck_pin, channel=channel, **kwargs)
+    else:
+        raise ValueError(f"Unknown sensor backend '{backend}', expected one of {SENSOR_BACKENDS}")
+
+    sensor.min_measures = 1
+    sensor.reset()
+    return sensor
+
+def create_sensors(pins, backend='hx711', **kwargs):
+    """Construct and reset the load cells of one scale in parallel, returned in pin order.
+
+    Each HX711 reset waits for the chip to power up and finish a conversion, which
+    would otherwise be paid once per load cell at startup.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=max(1, len(pins))) as executor:
+        futures = [executor.submit(create_sensor, dout_pin, pd_sck_pin, backend, channel, **kwargs)
+                   for channel, (dout_pin, pd_sck_pin) in enumerate(pins)]
+        return [future.result() for future in futures]
+
+def sensor_ready(sensor):
+    """Whether a conversion is waiting, so reading the sensor will not block.
+
+    Sensors without a ready check are always treated as ready.
+    """
+    ready = getattr(sensor, '_ready', None)
+    return ready() if ready is not None else True
+
+def sensor_period(sensor, default_rate=80.0):
+    """Seconds between conversions, from the sensor's own `sample_rate` if it has one, 0 if unthrottled.
+
+    The HX711's rate is set by its RATE pin, 10 or 80 SPS, so real sensors use `default_rate`.
+    """
+    rate = getattr(sensor, 'sample_rate', default_rate)
+    return 1.0 / rate if rate and rate > 0 else 0.0
+
+def parse_pins(text):
+    """Parse 'dout:sck,dout:sck,...' pin pairs, as used in the scale config sections."""
+    if not text:
+        return None
+    return tuple(tuple(int(pin) for pin in pair.split(':')) for pair in text.split(','))
+
+def release_gpio(backend):
+    if backend == 'hx711':
+        import RPi.GPIO as GPIO
+        GPIO.cleanup()
+
+def capture(capture_file, duration, backend='hx711', pins=DEFAULT_PINS):
+    """Record the raw readings of one scale to a .npy file, for replaying later."""
+    from acquisition import AcquisitionEngine
+
+    sensors = create_sensors(pins, backend)
+    engine = AcquisitionEngine(sensors)
+    engine.start()
+    try:
+        timestamps, readings = engine.read_frames(duration)
+    finally:
+        engine.stop()
+        release_gpio(backend)
+    np.save(capture_file, readings)
+    print(f"Captured {len(readings)} frames to {capture_file}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Record raw HX711 readings for the replay backend")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    capture_parser = subparsers.add_parser('capture', help="Record the raw readings of the four load cells")
+    capture_parser.add_argument("capture_file", type=str, help=".npy file to write")
+    capture_parser.add_argument("-d", "--duration", type=float, default=60.0, help="Seconds to record")
+    capture_parser.add_argument("-b", "--backend", type=str, default='hx711', choices=('hx711', 'fake'), help="Sensor backend")
+    capture_parser.add_argument("--pins", type=str, default=None, help="dout:sck pin pairs, comma separated")
+    args = parser.parse_args()
+
+    capture(args.capture_file, args.duration, args.backend, parse_pins(args.pins) or DEFAULT_PINS)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+#!/usr/bin/python3
+import argparse
+import multiprocessing
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from metrics import instrumentation, scale_label
+
+# Frames written so far and the ring's shape, padded to a cache line
+HEADER_DTYPE = np.dtype([('count', '<i8'), ('capacity', '<i8'), ('channels', '<i8'), ('reserved', 'V40')])
+
+class FrameRing:
+    """Raw frames in a multiprocessing.shared_memory block, written by one process and read by others.
+
+    Like SampleBuffer, each frame is stored twice, at `i` and `i + capacity`, so the newest
+    `capacity` frames are always one contiguous slice, copied out in one step. Each slot also
+    holds its frame's number as a seqlock: the writer sets it to -1 before writing the frame
+    and to the number after, and a reader keeps a copied frame only if the number was the
+    one it expected both before and after the copy, so frames being rewritten or already
+    lapped are never returned torn. Pass `name` to attach to a ring another process created.
+    """
+
+    def __init__(self, name=None, capacity=65536, channels=4):
+        self.owner = name is None
+        if self.owner:
+            size = HEADER_DTYPE.itemsize + 2 * capacity * (8 + 8 + 4 * channels)
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+
+        buffer = self.shm.buf
+        self._header = np.ndarray((), HEADER_DTYPE, buffer)
+        if self.owner:
+            self._header['count'] = 0
+            self._header['capacity'] = capacity
+            self._header['channels'] = channels
+        self.capacity = int(self._header['capacity'])
+        self.channels = int(self._header['channels'])
+
+        offset = HEADER_DTYPE.itemsize
+        self.sequence = np.ndarray(2 * self.capacity, '<i8', buffer, offset)
+        offset += self.sequence.nbytes
+        self.timestamps = np.ndarray(2 * self.capacity, '<f8', buffer, offset)
+        offset += self.timestamps.nbytes
+        self.readings = np.ndarray((2 * self.capacity, self.channels), '<i4', buffer, offset)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def count(self):
+        return int(self._header['count'])
+
+    def append(self, timestamp, readings):
+        # Only ever called from the one writing process
+        count = int(self._header['count'])
+        position = count % self.capacity
+        for slot in (position, position + self.capacity):
+            self.sequence[slot] = -1
+            self.timestamps[slot] = timestamp
+            self.readings[slot] = readings
+            self.sequence[slot] = count
+        self._header['count'] = count + 1
+
+    def read(self, start, end):
+        """Copies of the timestamps and readings of frames `start` to `end`, with a mask of those read intact."""
+        timestamps, readings, sequence = self.view(start, end)
+        expected = np.arange(start, start + len(sequence))
+        before = sequence == expected
+        timestamps, readings = timestamps.copy(), readings.copy()
+        return timestamps, readings, before & (sequence == expected)
+
+    def view(self, start, end):
+        """Views of the timestamps, readings and frame numbers of frames `start` to `end`, at most `capacity` of them."""
+        begin = start % self.capacity
+        stop = begin + (end - start)
+        return self.timestamps[begin:stop], self.readings[begin:stop], self.sequence[begin:stop]
+
+    def close(self):
+        # The views must go before the memory can be unmapped
+        del self._header, self.sequence, self.timestamps, self.readings
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+class SharedFrames:
+    """Frames from an acquisition process, read from a FrameRing through the AcquisitionEngine interface.
+
+    Scale reads these in place of its own engine when acquisition runs in another process.
+    Frames the reader falls a whole ring behind on, or finds rewritten under it, are counted
+    as dropped.
+    """
+
+    scheduler = None
+
+    def __init__(self, ring, name=None, poll_interval=0.01):
+        self.ring = ring
+        self.name = name
+        self.poll_interval = poll_interval
+        self.channels = ring.channels
+        self.cursor = ring.count
+        self.dropped_frames = 0
+        self.samples_per_second = 0.0
+
+    def start(self):
+        self.cursor = self.ring.count
+
+    def stop(self):
+        self.ring.close()
+
+    def discard_frames(self):
+        self.cursor = self.ring.count
+
+    def take(self):
+        """Copies of the frames written since the last call."""
+        count = self.ring.count
+        behind = count - self.cursor - self.ring.capacity
+        if behind > 0:
+            self.cursor += behind
+            self.drop(behind)
+        timestamps, readings, intact = self.ring.read(self.cursor, count)
+        self.cursor = count
+        if not intact.all():
+            self.drop(int(len(intact) - intact.sum()))
+            timestamps, readings = timestamps[intact], readings[intact]
+        return timestamps, readings
+
+    def drop(self, frames):
+        self.dropped_frames += frames
+        instrumentation.dropped_frames.inc(frames, label=scale_label(self.name))
+
+    def get_frame(self, timeout=None):
+        end_time = None if timeout is None else time.monotonic() + timeout
+        while True:
+            count = self.ring.count
+            if count > self.cursor:
+                behind = count - self.cursor - self.ring.capacity
+                if behind > 0:
+                    self.cursor += behind
+                    self.drop(behind)
+                timestamps, readings, intact = self.ring.read(self.cursor, self.cursor + 1)
+                self.cursor += 1
+                if intact[0]:
+                    return float(timestamps[0]), tuple(readings[0].tolist())
+                self.drop(1)
+                continue
+            if end_time is not None and time.monotonic() >= end_time:
+                raise TimeoutError("No frame from the acquisition process")
+            time.sleep(self.poll_interval)
+
+    def read_frames(self, duration, interrupt=None, done=None, min_frames=16):
+        """Collect the frames written over the next `duration` seconds, as AcquisitionEngine.read_frames."""
+        self.discard_frames()
+        capacity = max(64, int(duration * max(self.samples_per_second, 1.0) * 1.25))
+        timestamps = np.empty(capacity)
+        readings = np.empty((capacity, self.channels), dtype=np.int32)
+        count = 0
+        next_check = min_frames
+        start = time.monotonic()
+        end_time = start + duration
+        while True:
+            remaining = end_time - time.monotonic()
+            if remaining <= 0 or (interrupt is not None and interrupt.is_set()):
+                break
+            time.sleep(min(remaining, self.poll_interval))
+            new_timestamps, new_readings = self.take()
+            if not len(new_timestamps):
+                continue
+            needed = count + len(new_timestamps)
+            if needed > len(timestamps):
+                size = max(2 * len(timestamps), needed)
+                timestamps = np.resize(timestamps, size)
+                readings = np.resize(readings, (size, self.channels))
+            timestamps[count:needed] = new_timestamps
+            readings[count:needed] = new_readings
+            count = needed
+            if done is not None and count >= next_check:
+                if done(timestamps[:count], readings[:count]):
+                    break
+                next_check = count + max(1, count // 4)
+
+        elapsed = time.monotonic() - start
+        if count and elapsed > 0:
+            self.samples_per_second = count / elapsed
+        return timestamps[:count], readings[:count]
+
+def write_frames(ring_name, frames, rate):
+    """Writer side of the benchmark: `frames` frames at `rate` per second."""
+    ring = FrameRing(ring_name)
+    readings = np.arange(ring.channels, dtype=np.int32)
+    start = time.monotonic()
+    for i in range(frames):
+        ring.append(time.time(), readings + i)
+        time.sleep(max(0.0, start + (i + 1) / rate - time.monotonic()))
+    ring.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Check frames pass intact from a writer process through a FrameRing, and time appends")
+    parser.add_argument("-n", "--frames", type=int, default=400, help="Frames for the writer process to write")
+    parser.add_argument("-r", "--rate", type=float, default=80.0, help="Frames per second")
+    parser.add_argument("-c", "--capacity", type=int, default=1024, help="Ring capacity in frames")
+    args = parser.parse_args()
+
+    ring = FrameRing(capacity=args.capacity)
+    try:
+        start = time.perf_counter()
+        for i in range(10000):
+            ring.append(0.0, (i, i, i, i))
+        print(f"{1e6 * (time.perf_counter() - start) / 10000:.1f} us per append")
+
+        reader = SharedFrames(FrameRing(ring.name))
+        writer = multiprocessing.get_context('spawn').Process(target=write_frames, args=(ring.name, args.frames, args.rate))
+        writer.start()
+        timestamps, readings = reader.read_frames(args.frames / args.rate + 2.0)
+        writer.join()
+        intact = np.array_equal(readings[:, 1:] - readings[:, :1], np.tile(np.arange(1, ring.channels), (len(readings), 1)))
+        in_order = np.all(np.diff(readings[:, 0]) > 0)
+        print(f"Read {len(readings)} of {args.frames} frames, intact {intact}, in order {in_order}, "
+              f"dropped {reader.dropped_frames}, {reader.samples_per_second:.1f} frames/s")
+        reader.stop()
+    finally:
+        ring.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+#!/usr/bin/python3
+import argparse
+import time
+from bisect import bisect_left, insort
+from collections import deque
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# 1.2533 = sqrt(pi/2) converts a mean absolute deviation to a Gaussian sigma
+MAD_TO_SIGMA = 1.2533
+
+class RunningMedian:
+    """Median of the last `window` values.
+
+    The values are kept both in arrival order and in a sorted list, so each update is a
+    binary search plus a memmove of at most `window` elements.
+    """
+
+    def __init__(self, window, values=()):
+        self.window = window
+        self._values = deque()
+        self._sorted = []
+        for value in values:
+            self.push(value)
+
+    def push(self, value):
+        self._values.append(value)
+        insort(self._sorted, value)
+        if len(self._values) > self.window:
+            old = self._values.popleft()
+            del self._sorted[bisect_left(self._sorted, old)]
+
+    def median(self):
+        n = len(self._sorted)
+        if n % 2:
+            return self._sorted[n // 2]
+        return 0.5 * (self._sorted[n // 2 - 1] + self._sorted[n // 2])
+
+class FloatRing:
+    """Fixed capacity float ring buffer whose newest values are always a contiguous view."""
+
+    def __init__(self, capacity):
+        self.capacity = int(capacity)
+        self._data = np.zeros(2 * self.capacity)
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def _end(self):
+        return self.count % self.capacity + (self.capacity if self.count >= self.capacity else 0)
+
+    def append(self, value):
+        position = self.count % self.capacity
+        self._data[position] = value
+        self._data[position + self.capacity] = value
+        self.count += 1
+
+    def load(self, values):
+        """Replace the contents with `values`."""
+        values = np.asarray(values)[-self.capacity:]
+        self._data[:len(values)] = values
+        self._data[self.capacity:self.capacity + len(values)] = values
+        self.count = len(values)
+
+    def set_tail(self, values):
+        """Overwrite the newest len(values) entries."""
+        values = np.asarray(values)[-len(self):]
+        end = self._end()
+        positions = np.arange(end - len(values), end) % self.capacity
+        self._data[positions] = values
+        self._data[positions + self.capacity] = values
+
+    def view(self):
+        end = self._end()
+        return self._data[end - len(self):end]
+
+def exponential_filter(values, alpha, initial):
+    """Recursive x[k] = x[k-1] + alpha * (values[k] - x[k-1]), starting from x[-1] = initial."""
+    from scipy.signal import lfilter
+    filtered, _ = lfilter([alpha], [1.0, alpha - 1.0], values, zi=[initial * (1.0 - alpha)])
+    return filtered
+
+def filter_data(data, window):
+    """Median filter, outlier replacement and Wiener filter, three times over, as the original full smoothing."""
+    from scipy.signal import wiener, medfilt
+
+    # Ensure the window size is odd
+    if window % 2 == 0:
+        window = window + 1
+    
+    for i in range(3):
+        # Apply initial filter
+        if window > 1:
+            data_filtered = medfilt(data, window)
+        else:
+            data_filtered = data                
+    
+        # Identify and remove outliers
+        delta = np.abs(data_filtered - data)
+        sigma = np.std(delta)
+        outliers = delta < 3*sigma
+        data_cleaned = np.array(data)
+        data_cleaned[outliers] = data_filtered[outliers]
+        
+        # Reapply Wiener filter on cleaned data
+        if len(data_cleaned) > window:
+            data_final_filtered = wiener(data_cleaned, window)
+        else:
+            data_final_filtered = data
+            
+        data = np.array(data_filtered)
+        data_filtered = np.array(data_final_filtered)
+    
+    return data_final_filtered, sigma
+
+def effective_window(window, max_window):
+    window = max(3, min(int(window), int(max_window)))
+    if window % 2 == 0:
+        window = window + 1
+    return window
+
+def smooth_series(values, window, outlier_sigma=3.0):
+    """Batch version of the StreamingSmoother pipeline over a whole series.
+
+    1. Centred running median, with the ends point-reflected as Scale.measure does.
+    2. Values further than `outlier_sigma` from the median are replaced by the median,
+       using a recursive estimate of the noise.
+    3. A steady state Kalman (exponential) filter run forward then backward.
+
+    Returns the smoothed series plus the forward filter and noise states, which the
+    streaming smoother uses to continue from.
+    """
+    from scipy.ndimage import median_filter
+
+    values = np.asarray(values, dtype=float)
+    half = window // 2
+    alpha = 2.0 / (window + 1)
+
+    head = 2.0 * values[0] - values[1:half + 1][::-1]
+    tail = 2.0 * values[-1] - values[-half - 1:-1][::-1]
+    extended = np.concatenate([head, values, tail])
+    # Pad the reflection so short series still yield one median per value
+    extended = np.pad(extended, (half - len(head), half - len(tail)), mode='edge')
+    medians = median_filter(extended, size=window, mode='nearest')[half:half + len(values)]
+
+    deviation = np.abs(values - medians)
+    noise = exponential_filter(deviation, alpha, deviation[0])
+    outliers = deviation > outlier_sigma * MAD_TO_SIGMA * noise
+    cleaned = np.where(outliers, medians, values)
+
+    forward = exponential_filter(cleaned, alpha, cleaned[0])
+    smoothed = exponential_filter(forward[::-1], alpha, forward[-1])[::-1]
+    return smoothed, forward, noise
+
+class StreamingSmoother:
+    """Incremental equivalent of re-filtering the whole history every cycle.
+
+    Each update finalises the centred median of the sample `window // 2` behind the newest,
+    advances the forward filter by one step, and recomputes only the tail that the new sample
+    can still influence: the reflected medians of the last `window // 2` samples and the
+    backward pass over the last `backward_length` samples. `max_window` caps the cost of an update.
+    """
+
+    def __init__(self, capacity, window, max_window=301, outlier_sigma=3.0):
+        self.capacity = int(capacity)
+        self.window = effective_window(window, max_window)
+        self.half = self.window // 2
+        self.alpha = 2.0 / (self.window + 1)
+        self.outlier_sigma = outlier_sigma
+        # Samples further back than this are changed by less than 1% of a new sample's influence
+        self.backward_length = int(np.ceil(np.log(0.01) / np.log(1.0 - self.alpha))) + self.half
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self._raw = deque(maxlen=self.window)
+        self._median = RunningMedian(self.window)
+        self._forward = FloatRing(min(self.capacity, self.backward_length))
+        self._smoothed = FloatRing(self.capacity)
+        self._forward_state = 0.0
+        self._noise_state = 0.0
+
+    @property
+    def sigma(self):
+        return MAD_TO_SIGMA * self._noise_state
+
+    def prime(self, values):
+        """Reset the smoother to the result of a full recompute over `values`."""
+        self.clear()
+        values = np.asarray(values, dtype=float)[-self.capacity:]
+        if len(values) == 0:
+            return
+        self.count = len(values)
+        for value in values[-self.window:]:
+            self._raw.append(value)
+            self._median.push(value)
+
+        smoothed, forward, noise = smooth_series(values, self.window, self.outlier_sigma)
+        self._smoothed.load(smoothed)
+
+        # Continue the recursive filters from the newest finalised sample
+        finalised = len(values) - self.half
+        if finalised > 0:
+            self._forward.load(forward[:finalised])
+            self._forward_state = forward[finalised - 1]
+            self._noise_state = noise[finalised - 1]
+
+    def snapshot(self):
+        """Arrays that `restore` continues from."""
+        return {
+            'capacity': self.capacity,
+            'window': self.window,
+            'count': self.count,
+            'raw': np.array(self._raw, dtype=float),
+            'forward': np.array(self._forward.view()),
+            'smoothed': np.array(self._smoothed.view()),
+            'forward_state': self._forward_state,
+            'noise_state': self._noise_state,
+        }
+
+    def restore(self, snapshot):
+        """Continue from the `snapshot()` of a smoother with the same capacity and window."""
+        self.clear()
+        self.count = int(snapshot['count'])
+        for value in snapshot['raw'].tolist():
+            self._raw.append(value)
+            self._median.push(value)
+        self._forward.load(snapshot['forward'])
+        self._smoothed.load(snapshot['smoothed'])
+        self._forward_state = float(snapshot['forward_state'])
+        self._noise_state = float(snapshot['noise_state'])
+
+    def update(self, value):
+        """Add one sample and return the smoothed series."""
+        if self.count < self.window:
+            # Too few samples for a complete window, a full recompute is just as cheap
+            values = np.concatenate([np.array(self._raw, dtype=float), [value]])
+            self.prime(values)
+            return self.smoothed()
+
+        self.count += 1
+        self._raw.append(value)
+        self._median.push(value)
+        raw = np.array(self._raw, dtype=float)
+        half = self.half
+
+        # Finalise the sample at the centre of the now complete window
+        median = self._median.median()
+        deviation = abs(raw[half] - median)
+        self._noise_state += self.alpha * (deviation - self._noise_state)
+        cleaned = median if deviation > self.outlier_sigma * self.sigma else raw[half]
+        self._forward_state += self.alpha * (cleaned - self._forward_state)
+        self._forward.append(self._forward_state)
+
+        # Recompute the tail, whose windows extend past the newest sample
+        extended = np.concatenate([raw, 2.0 * value - raw[-half - 1:-1][::-1]])
+        tail_medians = np.median(sliding_window_view(extended, self.window)[1:half + 1], axis=1)
+        tail_values = raw[half + 1:]
+        tail_deviation = np.abs(tail_values - tail_medians)
+        tail_noise = exponential_filter(tail_deviation, self.alpha, self._noise_state)
+        tail_cleaned = np.where(tail_deviation > self.outlier_sigma * MAD_TO_SIGMA * tail_noise, tail_medians, tail_values)
+        tail_forward = exponential_filter(tail_cleaned, self.alpha, self._forward_state)
+
+        # Backward pass over the samples the new value can still influence
+        forward = np.concatenate([self._forward.view()[-(self.backward_length - half):], tail_forward])
+        backward = exponential_filter(forward[::-1], self.alpha, forward[-1])[::-1]
+        self._smoothed.append(value)
+        self._smoothed.set_tail(backward)
+        return self.smoothed()
+
+    def smoothed(self):
+        """Smoothed values aligned with the newest `capacity` samples."""
+        return self._smoothed.view()
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate the streaming smoother against a full recompute")
+    parser.add_argument("sample_file", type=str, nargs='?', default=None, help="Text file of medians, or omit for a synthetic spool")
+    parser.add_argument("-w", "--window", type=int, default=61, help="Smoothing window in samples")
+    parser.add_argument("-n", "--number", type=int, default=5000, help="Number of synthetic samples")
+    args = parser.parse_args()
+
+    if args.sample_file:
+        values = np.loadtxt(args.sample_file, ndmin=1)
+    else:
+        rng = np.random.default_rng(0)
+        values = 1000.0 - 0.05 * np.arange(args.number) + rng.normal(0, 1.0, args.number)
+        values[rng.integers(0, args.number, args.number // 100)] += 50.0
+
+    # Import and warm up scipy before timing
+    smooth_series(values[:10], 3)
+
+    start = time.perf_counter()
+    full, _, _ = smooth_series(values, effective_window(args.window, args.window))
+    full_time = time.perf_counter() - start
+
+    smoother = StreamingSmoother(len(values), args.window, max_window=args.window)
+    start = time.perf_counter()
+    for value in values:
+        smoother.update(value)
+    update_time = (time.perf_counter() - start) / len(values)
+
+    error = np.abs(smoother.smoothed() - full)
+    print(f"{len(values)} samples, window {smoother.window}")
+    print(f"Full recompute: {full_time * 1000:.2f} ms per cycle")
+    print(f"Incremental:    {update_time * 1000:.3f} ms per update")
+    print(f"Max difference {error.max():.4g}, RMS difference {np.sqrt(np.mean(error ** 2)):.4g}")
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,54 @@
+import queue
+import threading
+
 # Define possible states
 STATE_TARING = 'TARING'
 STATE_CALIBRATING = 'CALIBRATING'
 STATE_MEASURING = 'MEASURING'
-STATE_CLEARING = 'CLEARING'
\ No newline at end of file
+STATE_CLEARING = 'CLEARING'
+
+class ScaleHandle:
+    """One scale with its command queue, config section and chart renderer.
+
+    `scale` is None while the scale's sensors are being reset, so the HTTP server can
+    answer, and queue commands, before the Scale exists.
+    """
+
+    def __init__(self, name, scale, commands, settings, renderer):
+        self.name = name
+        self.scale = scale
+        self.commands = commands
+        self.settings = settings
+        self.renderer = renderer
+
+    @property
+    def status(self):
+        return 'initialising' if self.scale is None else 'ready'
+
+class CommandQueue:
+    """Commands from the HTTP server to the measuring loop.
+
+    Only the most recent command is kept. Posting one also sets `interrupt`, so a
+    measurement window in progress ends early and the command runs straight away.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=1)
+        self._lock = threading.Lock()
+        self.interrupt = threading.Event()
+
+    def put(self, state, **params):
+        with self._lock:
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            self._queue.put_nowait((state, params))
+            self.interrupt.set()
+
+    def get(self):
+        """Return the pending (state, params), or measuring if there is none."""
+        with self._lock:
+            self.interrupt.clear()
+            try:
+                return self._queue.get_nowait()
+            except queue.Empty:
+                return STATE_MEASURING, {}
@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+import multiprocessing
+import signal
+import sys
+import threading
+import time
+
+from metrics import startup
+from sensors import create_sensors, release_gpio
+from acquisition import AcquisitionEngine, AcquisitionScheduler
+from shared_frames import FrameRing
+from hx4 import load_config_and_parse_args, run, scale_sections, sensor_config, signal_handler
+
+def acquisition_main(scales, rings, workers, data_rate):
+    """Read every scale's sensors, writing each frame into the scale's ring, until terminated."""
+    # Ctrl+C reaches the whole process group, the supervisor decides what stops
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal_handler)
+    scheduler = AcquisitionScheduler(workers, data_rate=data_rate)
+    engines = []
+    attached = []
+    try:
+        for name, backend, pins, sensor_options in scales:
+            ring = FrameRing(rings[name])
+            attached.append(ring)
+            sensors = create_sensors(pins, backend, **sensor_options)
+            engine = AcquisitionEngine(sensors, scheduler=scheduler, name=name, sink=ring.append)
+            engine.start()
+            engines.append(engine)
+        startup.mark('acquisition')
+        threading.Event().wait()
+    finally:
+        for engine in engines:
+            engine.stop()
+        scheduler.stop()
+        for backend in set(scale[1] for scale in scales):
+            release_gpio(backend)
+        for ring in attached:
+            ring.close()
+
+def worker_main(argv, rings):
+    """The measuring, HTTP and rendering side of hx4.py, reading frames from the rings.
+
+    These stay together in one process, each on threads of its own, as the server and the
+    renderer read the history, smoothing and events the state machines keep in memory.
+    Only acquisition, whose timing matters most, is moved out of their way.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal_handler)
+    sys.argv = argv
+    args, settings = load_config_and_parse_args()
+    run(args, settings, rings)
+
+class Supervisor:
+    """Keeps named child processes running, restarting any that exits.
+
+    A child that fails again within `stable_seconds` of starting waits twice as long
+    before its next restart, up to `max_delay`.
+    """
+
+    def __init__(self, context, restart_delay=1.0, max_delay=60.0, stable_seconds=60.0):
+        self.context = context
+        self.restart_delay = restart_delay
+        self.max_delay = max_delay
+        self.stable_seconds = stable_seconds
+        self.children = {}
+
+    def start(self, name, target, args):
+        self.children[name] = {'target': target, 'args': args, 'process': None,
+                               'started': 0.0, 'delay': self.restart_delay, 'restart_at': 0.0}
+        self._spawn(name)
+
+    def _spawn(self, name):
+        child = self.children[name]
+        process = self.context.Process(target=child['target'], args=child['args'], name=name)
+        process.start()
+        child['process'] = process
+        child['started'] = time.monotonic()
+        print(f"Started {name} process {process.pid}")
+
+    def poll(self):
+        now = time.monotonic()
+        for name, child in self.children.items():
+            process = child['process']
+            if process is not None and not process.is_alive():
+                if now - child['started'] >= self.stable_seconds:
+                    child['delay'] = self.restart_delay
+                print(f"The {name} process exited with code {process.exitcode}, restarting in {child['delay']:.0f} s")
+                child['process'] = None
+                child['restart_at'] = now + child['delay']
+                child['delay'] = min(2 * child['delay'], self.max_delay)
+            elif process is None and now >= child['restart_at']:
+                self._spawn(name)
+
+    def stop(self, name, timeout=30.0):
+        # SIGTERM, so the child shuts down as it would on its own
+        process = self.children.pop(name)['process']
+        if process is None:
+            return
+        process.terminate()
+        process.join(timeout)
+        if process.is_alive():
+            print(f"The {name} process did not stop, killing it")
+            process.kill()
+            process.join()
+
+def supervise(args, settings):
+    """Run acquisition and everything else in separate processes sharing frames through memory.
+
+    The acquisition process owns the GPIO and writes every frame into a FrameRing per scale.
+    The worker process runs the state machines, HTTP server and renderers on those frames.
+    Either is restarted if it dies, and acquisition carries on while the worker restarts.
+    """
+    context = multiprocessing.get_context('spawn')
+    scales = [(name,) + sensor_config(args, section) for name, section in scale_sections(settings)]
+    capacity = settings.getint('ring_frames', 65536)
+    rings = {name: FrameRing(capacity=capacity, channels=len(pins)) for name, backend, pins, options in scales}
+    ring_names = {name: ring.name for name, ring in rings.items()}
+
+    supervisor = Supervisor(context, settings.getfloat('restart_delay', 1.0))
+    try:
+        supervisor.start('acquisition', acquisition_main, (scales, ring_names,
+                         settings.getint('acquisition_workers', 4), settings.getfloat('hx711_rate', 80.0)))
+        supervisor.start('worker', worker_main, (sys.argv, ring_names))
+        while True:
+            supervisor.poll()
+            time.sleep(0.5)
+    finally:
+        # The worker first, so it still has frames while it finishes its window and flushes
+        for name in ('worker', 'acquisition'):
+            if name in supervisor.children:
+                supervisor.stop(name)
+        for ring in rings.values():
+            ring.close()